@@ -0,0 +1,52 @@
+import xarray as xa
+from collections import OrderedDict
+from typing import Any, Dict, List, Tuple, Type, Optional, Union, Set
+
+class DatasetPool:
+	"""  Pool of open datasets keyed by path (and open kwargs), closing the least recently used dataset beyond max_open.  Decoded index
+	     coordinates are kept per path, so reopening a previously evicted file skips re-reading and re-decoding its grid.  """
+
+	def __init__(self, max_open: int = 32 ):
+		self.max_open: int = max( max_open, 1 )
+		self._datasets: OrderedDict = OrderedDict()
+		self._coords: Dict[str,Dict[str,xa.Variable]] = {}
+		self._seen: Set[str] = set()
+		self.hits: int = 0
+		self.opens: int = 0
+		self.reopens: int = 0
+		self.closes: int = 0
+
+	@classmethod
+	def key(cls, path: str, kwargs: Dict ) -> str:
+		return path if len(kwargs) == 0 else f"{path}:{sorted( [ (k, repr(v)) for k, v in kwargs.items() ] )}"
+
+	def open(self, path: str, **kwargs ) -> xa.Dataset:
+		key: str = self.key( path, kwargs )
+		dset: Optional[xa.Dataset] = self._datasets.get( key )
+		if dset is not None:
+			self.hits += 1
+			self._datasets.move_to_end( key )
+			return dset
+		self.opens += 1
+		coords: Optional[Dict[str,xa.Variable]] = self._coords.get( path )
+		if key in self._seen:
+			self.reopens += 1
+		if coords is not None:
+			dset = xa.open_dataset( path, drop_variables=list(coords.keys()), **kwargs ).assign_coords( coords )
+		else:
+			dset = xa.open_dataset( path, **kwargs )
+			self._coords[path] = { cn: cv.variable for cn, cv in dset.coords.items() if (cn in dset.dims) and (cn != 'time') }
+		self._seen.add( key )
+		self._datasets[key] = dset
+		while len(self._datasets) > self.max_open:
+			self._datasets.popitem( last=False )[1].close()
+			self.closes += 1
+		return dset
+
+	def close(self):
+		for dset in self._datasets.values(): dset.close()
+		self.closes += len(self._datasets)
+		self._datasets.clear()
+
+	def stats(self) -> Dict[str,int]:
+		return dict( open=len(self._datasets), hits=self.hits, opens=self.opens, reopens=self.reopens, closes=self.closes )
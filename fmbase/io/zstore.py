@@ -0,0 +1,84 @@
+import os, shutil, numpy as np
+import xarray as xa
+import dask.array as da
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List, Tuple, Type, Optional, Union
+
+class DailyZarrStore:
+	"""  Single chunked Zarr store holding a contiguous range of days along 'time', filled by per-day region writes.  Each completed
+	     region write is recorded by a marker file, so reading a day that was never written raises instead of returning NaN fill.  """
+
+	def __init__(self, path: str, start: date, ndays: int, tstep_hours: int ):
+		self.path: str = path
+		self.start: date = start
+		self.ndays: int = ndays
+		self.tstep_hours: int = tstep_hours
+		self.steps_per_day: int = 24 // tstep_hours
+		self._dataset: Optional[xa.Dataset] = None
+
+	@property
+	def initialized(self) -> bool:
+		return os.path.exists( f"{self.path}/.zmetadata" ) or os.path.exists( f"{self.path}/zarr.json" )
+
+	def time_slice(self, d: date, ndays: int = 1 ) -> slice:
+		iday: int = (d - self.start).days
+		if (iday < 0) or (iday + ndays > self.ndays):
+			raise Exception( f"DailyZarrStore: days {d} + {ndays} outside of store range [{self.start}, {self.ndays} days]" )
+		return slice( iday*self.steps_per_day, (iday+ndays)*self.steps_per_day )
+
+	def marker_path(self, d: date ) -> str:
+		return f"{self.path}.written/{d.isoformat()}"
+
+	def written(self, d: date ) -> bool:
+		return os.path.exists( self.marker_path(d) )
+
+	def times(self) -> np.ndarray:
+		t0: np.datetime64 = np.datetime64( datetime(self.start.year, self.start.month, self.start.day), 'ns' )
+		return t0 + np.arange( self.ndays*self.steps_per_day ) * np.timedelta64( self.tstep_hours, 'h' )
+
+	def initialize(self, template: xa.Dataset ):
+		ntimes: int = self.ndays*self.steps_per_day
+		variables: Dict[str,xa.Variable] = {}
+		for vname, var in template.variables.items():
+			if ('time' in var.dims) and (vname != 'time'):
+				shape = tuple( ntimes if dim == 'time' else size for dim, size in zip(var.dims, var.shape) )
+				chunks = tuple( self.steps_per_day if dim == 'time' else size for dim, size in zip(var.dims, var.shape) )
+				variables[vname] = xa.Variable( var.dims, da.full( shape, np.nan, chunks=chunks, dtype=var.dtype ), attrs=var.attrs )
+		full: xa.Dataset = xa.Dataset( { vn: v for vn, v in variables.items() if vn in template.data_vars }, attrs=template.attrs )
+		coords = { cn: template.coords[cn] for cn in template.coords if 'time' not in template.coords[cn].dims }
+		coords.update( { cn: v for cn, v in variables.items() if cn in template.coords } )
+		coords['time'] = self.times()
+		full = full.assign_coords( **coords )
+		full.to_zarr( self.path, mode="w", compute=False, consolidated=True )
+		shutil.rmtree( f"{self.path}.written", ignore_errors=True )
+		print( f" >> Initialized zarr store '{self.path}' with {ntimes} time steps: {list(full.data_vars.keys())}")
+
+	def write_day(self, d: date, dset: xa.Dataset ):
+		if not self.initialized: self.initialize( dset )
+		static: List[str] = [ vn for vn, v in dset.variables.items() if ('time' not in v.dims) or (vn == 'time') ]
+		dset.drop_vars( static ).to_zarr( self.path, region={'time': self.time_slice(d)}, consolidated=True )
+		os.makedirs( os.path.dirname( self.marker_path(d) ), mode=0o777, exist_ok=True )
+		with open( self.marker_path(d), "w" ): pass
+
+	def open(self, **kwargs) -> xa.Dataset:
+		if self._dataset is None:
+			self._dataset = xa.open_zarr( self.path, consolidated=True, **kwargs )
+		return self._dataset
+
+	def read_days(self, d: date, ndays: int = 1, **kwargs ) -> xa.Dataset:
+		missing: List[date] = [ d + timedelta(days=iday) for iday in range(ndays) if not self.written( d + timedelta(days=iday) ) ]
+		if len(missing) > 0:
+			raise FileNotFoundError( f"DailyZarrStore: days {[ md.isoformat() for md in missing ]} have not been written to store '{self.path}'" )
+		return self.open( **kwargs ).isel( time=self.time_slice( d, ndays ) )
+
+	def close(self):
+		if self._dataset is not None:
+			self._dataset.close()
+			self._dataset = None
+
+def open_daily_store( path: str ) -> DailyZarrStore:
+	with xa.open_zarr( path, consolidated=True ) as dset:
+		times: np.ndarray = dset.coords['time'].values
+	tstep_hours: int = int( (times[1] - times[0]) / np.timedelta64(1,'h') )
+	t0 = times[0].astype('datetime64[D]').item()
+	return DailyZarrStore( path, t0, times.size*tstep_hours//24, tstep_hours )
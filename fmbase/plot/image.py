@@ -17,7 +17,10 @@ def rmse( diff: xa.DataArray, **kw ) -> xa.DataArray:
 	rms_error = np.array( [ rms(diff, time=iT, **kw) for iT in range(diff.shape[0]) ] )
 	return xa.DataArray( rms_error, dims=['time'], coords={'time': diff.time} )
 
-def cscale( pvar: xa.DataArray, stretch: float = 2.0 ) -> Tuple[float,float]:
+def cscale( pvar: xa.DataArray, stretch: float = 2.0, quantiles: xa.DataArray = None, qrange: Tuple[float,float] = (0.01,0.99) ) -> Tuple[float,float]:
+	if quantiles is not None:
+		qlo, qhi = [ quantiles.sel( quantile=q, method="nearest" ) for q in qrange ]
+		return float( qlo.min() ), float( qhi.max() )
 	meanv, stdv, minv = pvar.values.mean(), pvar.values.std(), pvar.values.min()
 	vmin = max( minv, meanv - stretch*stdv )
 	vmax = meanv + stretch*stdv
@@ -26,8 +29,10 @@ def cscale( pvar: xa.DataArray, stretch: float = 2.0 ) -> Tuple[float,float]:
 def normalize( target: xa.Dataset, vname: str, **kwargs ) -> xa.DataArray:
 	statnames: Dict[str,str] = kwargs.get('statnames', dict(mean='mean', std='std'))
 	norms: Dict[str,xa.Dataset] = kwargs.pop( 'norms', {} )
+	normalizer = kwargs.get( 'normalizer', None )
 	fvar: xa.DataArray = target.data_vars[vname]
 	if 'batch' in fvar.dims:  fvar = fvar.squeeze(dim="batch", drop=True)
+	if normalizer is not None: return normalizer.normalize_dataset( xa.Dataset( {vname: fvar} ) ).data_vars[vname]
 	if len(norms) == 0: return fvar
 	stats: Dict[str,xa.DataArray] = { stat: statdata.data_vars[vname] for stat,statdata in norms.items()}
 	return (fvar-stats[ statnames['mean'] ]) / stats[ statnames['std'] ]
@@ -36,6 +41,7 @@ def normalize( target: xa.Dataset, vname: str, **kwargs ) -> xa.DataArray:
 def mplplot( target: xa.Dataset, vnames: List[str],  task_spec: Dict, **kwargs ):
 	ims, pvars, nvars, ptypes = {}, {}, len(vnames), ['']
 	forecast: Optional[xa.Dataset] = kwargs.pop('forecast',None)
+	qstats: Optional[xa.Dataset] = kwargs.pop( 'quantiles', None )
 	time: xa.DataArray = xaformat_timedeltas( target.coords['time'] )
 	levels: xa.DataArray = target.coords['level']
 	lunits : str = levels.attrs.get('units','')
@@ -49,6 +55,8 @@ def mplplot( target: xa.Dataset, vnames: List[str],  task_spec: Dict, **kwargs )
 	tslider: ipw.IntSlider = ipw.IntSlider( value=0, min=0, max=time.size-1, description='Time Index:', )
 	print_data_column( target, vnames[0], **kwargs )
 	errors: Dict[str,xa.DataArray] = {}
+	normalized: bool = ( len( kwargs.get('norms',{}) ) > 0 ) or ( kwargs.get('normalizer') is not None )
+	qstats = None if normalized else qstats
 
 	with plt.ioff():
 		fig, axs = plt.subplots(nrows=nvars, ncols=ncols, sharex=True, sharey=True, figsize=[ncols*5, nvars*3], layout="tight")
@@ -65,7 +73,7 @@ def mplplot( target: xa.Dataset, vnames: List[str],  task_spec: Dict, **kwargs )
 		for it, pvar in enumerate( plotvars ):
 			ax = axs[ iv ] if ncols == 1 else axs[ iv, it ]
 			ax.set_aspect(0.5)
-			if it != 1: vrange = cscale( pvar, 2.0 )
+			if it != 1: vrange = cscale( pvar, 2.0, qstats.data_vars.get(vname) if ( (it == 0) and (qstats is not None) ) else None )
 			tslice: xa.DataArray = pvar.isel(time=tslider.value)
 			if "level" in tslice.dims:
 				tslice = tslice.isel(level=lslider.value)
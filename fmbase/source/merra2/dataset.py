@@ -0,0 +1,102 @@
+import xarray as xa
+import os, numpy as np
+from typing import Any, Dict, List, Tuple, Type, Optional, Union, Iterator
+from datetime import date
+from fmbase.source.merra2.model import FMBatch, BatchType
+
+class FMDataset:
+	"""  Map-style dataset (torch.utils.data.Dataset protocol: __len__/__getitem__) over (reference date, day_offset) samples.
+	     The FMBatch, with its const/norm files and day cache, is opened lazily in each worker process on first access.  """
+
+	def __init__(self, task_config: Dict, dates: List[date], btype: BatchType = BatchType.Training, **kwargs ):
+		self.task_config: Dict = task_config
+		self.btype: BatchType = btype
+		self.dates: List[date] = list(dates)
+		self.use_feature_store: bool = kwargs.pop( 'feature_store', False )
+		self.kwargs: Dict = kwargs
+		self.steps_per_day: int = int( 24 / task_config['data_timestep'] )
+		self.samples: List[Tuple[date,int]] = [ (d, offset) for d in self.dates for offset in range(self.steps_per_day) ]
+		self._batch: Optional[FMBatch] = None
+		self._pid: Optional[int] = None
+		self._current: Tuple[Optional[date],Optional[xa.Dataset]] = (None, None)
+
+	def __getstate__(self) -> Dict:
+		state: Dict = self.__dict__.copy()
+		state.update( _batch=None, _pid=None, _current=(None, None) )
+		return state
+
+	@property
+	def batch(self) -> FMBatch:
+		if (self._batch is None) or (self._pid != os.getpid()):
+			self._batch = FMBatch( self.task_config, self.btype, **self.kwargs )
+			self._pid = os.getpid()
+			self._current = (None, None)
+		return self._batch
+
+	def __len__(self) -> int:
+		return len( self.samples )
+
+	def __getitem__(self, index: int ) -> Union[xa.Dataset,np.ndarray]:
+		d, day_offset = self.samples[index]
+		if self.use_feature_store:
+			return self.batch.get_train_array( d, day_offset, normalize=self.task_config.get('normalize',False) )
+		if self._current[0] != d:
+			self._current = ( d, self.batch.assemble_batch( d ) )
+		return self._current[1].isel( time=slice( day_offset, day_offset + self.batch.batch_steps ) )
+
+class ShardedSampler:
+	"""  Deterministic per-epoch shuffled sampler (torch.utils.data.Sampler protocol) over an FMDataset, sharded across replicas by
+	     reference date so that each replica only reads its own days.  All offsets of a date are yielded contiguously; loader workers
+	     only keep whole dates if the loader batch size is a multiple of steps_per_day, otherwise use DateBatchSampler.  """
+
+	def __init__(self, dataset: FMDataset, num_replicas: int = 1, rank: int = 0, shuffle: bool = True, seed: int = 0 ):
+		assert 0 <= rank < num_replicas, f"Invalid rank {rank} for {num_replicas} replicas"
+		self.dataset: FMDataset = dataset
+		self.num_replicas: int = num_replicas
+		self.rank: int = rank
+		self.shuffle: bool = shuffle
+		self.seed: int = seed
+		self.epoch: int = 0
+
+	def set_epoch(self, epoch: int ):
+		self.epoch = epoch
+
+	def shard_dates(self) -> List[int]:
+		ndates: int = len( self.dataset.dates )
+		order: np.ndarray = np.random.default_rng( self.seed + self.epoch ).permutation( ndates ) if self.shuffle else np.arange( ndates )
+		ndates_per_replica: int = ndates // self.num_replicas
+		return order[ self.rank*ndates_per_replica: (self.rank+1)*ndates_per_replica ].tolist()
+
+	def __iter__(self) -> Iterator[int]:
+		rng = np.random.default_rng( (self.seed, self.epoch, self.rank) )
+		spd: int = self.dataset.steps_per_day
+		for idate in self.shard_dates():
+			offsets: np.ndarray = rng.permutation( spd ) if self.shuffle else np.arange( spd )
+			for offset in offsets.tolist():
+				yield idate*spd + offset
+
+	def __len__(self) -> int:
+		return ( len( self.dataset.dates ) // self.num_replicas ) * self.dataset.steps_per_day
+
+class DateBatchSampler:
+	"""  Batch sampler (torch.utils.data.BatchSampler protocol, passed as DataLoader(batch_sampler=...)) yielding one batch of indices
+	     per reference date of a ShardedSampler.  A data loader hands each batch to a single worker, so every date is assembled and
+	     read by exactly one worker, independent of any loader batch_size.  """
+
+	def __init__(self, sampler: ShardedSampler ):
+		self.sampler: ShardedSampler = sampler
+
+	def set_epoch(self, epoch: int ):
+		self.sampler.set_epoch( epoch )
+
+	def __iter__(self) -> Iterator[List[int]]:
+		spd: int = self.sampler.dataset.steps_per_day
+		batch: List[int] = []
+		for index in self.sampler:
+			batch.append( index )
+			if len(batch) == spd:
+				yield batch
+				batch = []
+
+	def __len__(self) -> int:
+		return len( self.sampler ) // self.sampler.dataset.steps_per_day
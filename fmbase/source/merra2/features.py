@@ -0,0 +1,78 @@
+import xarray as xa
+import os, json, numpy as np
+from typing import Any, Dict, List, Tuple, Type, Optional, Union, Sequence, Mapping
+from datetime import date, datetime
+from fmbase.source.merra2.model import FMBatch, feature_store_path
+
+class FeatureStore:
+	"""  Packed float32 feature tensor of a processed dataset_version, laid out as (time, lat, lon, channel) in a memory-mapped .npy file,
+	     with a JSON index of channels and time steps. Samples are returned as zero-copy views into the read-only memmap.  """
+
+	def __init__(self, path: str ):
+		self.path: str = path
+		with open( f"{path}/index.json" ) as f:
+			self.index: Dict[str,Any] = json.load( f )
+		self.array: np.ndarray = np.load( f"{path}/features.npy", mmap_mode='r' )
+		self.channels: List[str] = self.index['channels']
+		self.steps_per_day: int = self.index['steps_per_day']
+		self.start: date = date.fromisoformat( self.index['dates'][0] )
+
+	@classmethod
+	def var_channels(cls, vname: str, dvar: xa.DataArray, zc: str ) -> List[str]:
+		if zc in dvar.dims: return [ f"{vname}.{lev}" for lev in dvar.coords[zc].values.tolist() ]
+		return [ vname ]
+
+	@classmethod
+	def build(cls, fmbatch: FMBatch, dates: List[date] ) -> "FeatureStore":
+		tc: Dict = fmbatch.task_config
+		cmap: Dict[str,str] = tc.get( 'coords', dict(x='x', y='y', z='z') )
+		xc, yc, zc = cmap.get('x','x'), cmap.get('y','y'), cmap.get('z','z')
+		constant_vars: List[str] = tc.get( 'constants', [] )
+		path: str = feature_store_path( tc['dataset_version'] )
+		os.makedirs( path, mode=0o777, exist_ok=True )
+		spd: int = int( fmbatch.steps_per_day )
+		sample: xa.Dataset = fmbatch.load_dataset( dates[0] )
+		vnames: List[str] = [ vn for vn, dv in sample.data_vars.items() if ('time' in dv.dims) and (vn not in constant_vars) ]
+		channels: List[str] = sum( [ cls.var_channels( vn, sample.data_vars[vn], zc ) for vn in vnames ], [] )
+		ny, nx = sample.sizes[yc], sample.sizes[xc]
+		shape = ( len(dates)*spd, ny, nx, len(channels) )
+		features: np.ndarray = np.lib.format.open_memmap( f"{path}/features.npy.tmp", mode='w+', dtype=np.float32, shape=shape )
+		times: List[str] = []
+		for iday, d in enumerate( dates ):
+			dset: xa.Dataset = sample if (iday == 0) else fmbatch.load_dataset( d )
+			t0, ic = iday*spd, 0
+			for vn in vnames:
+				dvar: xa.DataArray = dset.data_vars[vn]
+				dvar = dvar.squeeze( [ dim for dim in dvar.dims if dim not in ('time', yc, xc, zc) ], drop=True )
+				dvar = dvar.broadcast_like( dset.coords[yc] ).broadcast_like( dset.coords[xc] )
+				dvar = dvar.transpose( 'time', yc, xc, *( [zc] if zc in dvar.dims else [] ) )
+				nc: int = dvar.sizes[zc] if zc in dvar.dims else 1
+				features[ t0:t0+spd, :, :, ic:ic+nc ] = dvar.values.reshape( spd, ny, nx, nc )
+				ic += nc
+			times.extend( [ str(np.datetime_as_string(t, unit='s')) for t in dset.coords['time'].values ] )
+			dset.close()
+		features.flush()
+		del features
+		os.replace( f"{path}/features.npy.tmp", f"{path}/features.npy" )
+		index = dict( channels=channels, variables=vnames, steps_per_day=spd, times=times, dates=[ d.isoformat() for d in dates ],
+		              coords={ yc: sample.coords[yc].values.tolist(), xc: sample.coords[xc].values.tolist() }, shape=list(shape) )
+		with open( f"{path}/index.json", "w" ) as f:
+			json.dump( index, f )
+		print( f" >> Built feature store '{path}': shape={shape}, channels={len(channels)}")
+		return FeatureStore( path )
+
+	def time_index(self, d: date ) -> int:
+		iday: int = (d - self.start).days
+		if (iday < 0) or (iday >= len(self.index['dates'])) or (self.index['dates'][iday] != d.isoformat()):
+			raise Exception( f"FeatureStore: date {d} not found in feature store '{self.path}'" )
+		return iday*self.steps_per_day
+
+	def channel_slice(self, vname: str ) -> slice:
+		ichannels: List[int] = [ ic for ic, cn in enumerate(self.channels) if (cn == vname) or cn.startswith(f"{vname}.") ]
+		return slice( ichannels[0], ichannels[-1]+1 )
+
+	def sample(self, d: date, day_offset: int, nsteps: int ) -> np.ndarray:
+		t0: int = self.time_index(d) + day_offset
+		if t0 + nsteps > self.array.shape[0]:
+			raise Exception( f"FeatureStore: sample [{t0}:{t0+nsteps}] exceeds feature store length {self.array.shape[0]}" )
+		return self.array[ t0:t0+nsteps ]
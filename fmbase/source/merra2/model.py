@@ -1,10 +1,15 @@
 import xarray as xa, pandas as pd
-import os, math, numpy as np
-from typing import Any, Dict, List, Tuple, Type, Optional, Union, Sequence, Mapping
+import os, math, queue, threading, numpy as np
+from typing import Any, Dict, List, Tuple, Type, Optional, Union, Sequence, Mapping, Callable, Iterable, Iterator
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
 from fmbase.util.ops import fmbdir
 from fmbase.source.merra2.preprocess import StatsAccumulator
+from fmbase.io.zstore import DailyZarrStore, open_daily_store
+from fmbase.io.pool import DatasetPool
+from fmbase.source.merra2.normalize import Normalizer
 from fmbase.util.dates import drepr, date_list
-from datetime import date
+from datetime import date, timedelta
 from fmbase.util.config import cfg
 from pandas import Timestamp
 from enum import Enum
@@ -23,6 +28,18 @@ def nnan(varray: xa.DataArray) -> int: return np.count_nonzero(np.isnan(varray.v
 def pctnan(varray: xa.DataArray) -> str: return f"{nnan(varray)*100.0/varray.size:.2f}%"
 def cache_var_filepath(version: str, d: date) -> str:
 	return f"{fmbdir('processed')}/{version}/{drepr(d)}.nc"
+def cache_stats_filepath(version: str, d: date) -> str:
+	return f"{fmbdir('processed')}/{version}/{drepr(d)}.stats.pkl"
+def cache_year_stats_filepath(version: str, year: int) -> str:
+	return f"{fmbdir('processed')}/{version}/stats/years/{year}.stats.pkl"
+def cache_const_stats_filepath(version: str) -> str:
+	return f"{fmbdir('processed')}/{version}/const.stats.pkl"
+def cache_zarr_path(version: str) -> str:
+	return f"{fmbdir('processed')}/{version}/data.zarr"
+def feature_store_path(version: str) -> str:
+	return f"{fmbdir('processed')}/{version}/features"
+def manifest_filepath(version: str) -> str:
+	return f"{fmbdir('processed')}/{version}/manifest.txt"
 def cache_const_filepath(version: str) -> str:
 	return f"{fmbdir('processed')}/{version}/const.nc"
 def stats_filepath(version: str, statname: str) -> str:
@@ -31,8 +48,47 @@ def d2xa( dvals: Dict[str,float] ) -> xa.Dataset:
     return xa.Dataset( {vn: xa.DataArray( np.array(dval) ) for vn, dval in dvals.items()} )
 
 def clear_const_file():
-	const_filepath = cache_const_filepath(cfg().preprocess.version)
-	if os.path.exists(const_filepath): os.remove( const_filepath )
+	for const_filepath in [ cache_const_filepath(cfg().preprocess.version), cache_const_stats_filepath(cfg().preprocess.version) ]:
+		if os.path.exists(const_filepath): os.remove( const_filepath )
+
+class DayCache:
+	"""  LRU cache of decoded, renamed per-day datasets bounded by a memory budget (bytes), with hit/miss counters.  """
+
+	def __init__(self, max_bytes: int ):
+		self.max_bytes: int = max_bytes
+		self._datasets: OrderedDict = OrderedDict()
+		self.nbytes: int = 0
+		self.hits: int = 0
+		self.misses: int = 0
+
+	@property
+	def enabled(self) -> bool:
+		return self.max_bytes > 0
+
+	def get(self, d: date, loader: Callable[[date],xa.Dataset] ) -> xa.Dataset:
+		dset: Optional[xa.Dataset] = self._datasets.get(d)
+		if dset is not None:
+			self.hits += 1
+			self._datasets.move_to_end(d)
+			return dset
+		self.misses += 1
+		dset = loader(d)
+		if self.enabled:
+			dset = dset.load()
+			if dset.nbytes <= self.max_bytes:
+				self._datasets[d] = dset
+				self.nbytes += dset.nbytes
+				while self.nbytes > self.max_bytes:
+					_, evicted = self._datasets.popitem( last=False )
+					self.nbytes -= evicted.nbytes
+		return dset
+
+	def clear(self):
+		self._datasets.clear()
+		self.nbytes = 0
+
+	def stats(self) -> Dict[str,int]:
+		return dict( hits=self.hits, misses=self.misses, ndays=len(self._datasets), nbytes=self.nbytes )
 
 class FMBatch:
 
@@ -44,9 +100,17 @@ class FMBatch:
 		self.target_steps = self.get_target_steps()
 		self.batch_steps: int = task_config['input_steps'] + self.target_steps
 		self.days_per_batch = self.get_days_per_batch()
+		self.lazy: bool = task_config.get('lazy',False)
+		self.file_pool = DatasetPool( task_config.get('max_open_files',32) )
 		self.constants: xa.Dataset = self.load_const_dataset( **kwargs )
 		self.norm_data: Dict[str, xa.Dataset] = self.load_merra2_norm_data()
 		self.current_batch: xa.Dataset = None
+		self.storage: str = task_config.get('storage','netcdf')
+		self._zstore: Optional[DailyZarrStore] = None
+		self._feature_store = None
+		self._normalizer: Optional[Normalizer] = None
+		self._quantiles: Optional[xa.Dataset] = None
+		self.day_cache = DayCache( 0 if self.lazy else int( task_config.get('day_cache_mb',2048) * 2**20 ) )
 
 	def get_target_steps(self):
 		if   self.type == BatchType.Training: return self.task_config['train_steps']
@@ -99,24 +163,117 @@ class FMBatch:
 		return xa.merge( [dynamics, constants], compat='override' )
 
 	def load_batch( self, d: date, **kwargs ):
-		bdays = date_list(d,self.days_per_batch)
-		time_slices: List[xa.Dataset] = [ self.load_dataset( d, **kwargs ) for d in bdays ]
-		self.current_batch: xa.Dataset =  self.merge_batch( time_slices, self.constants )
+		self.current_batch: xa.Dataset = self.assemble_batch( d, **kwargs )
+
+	def rollout( self, start: date, **kwargs ) -> "ForecastRollout":
+		return ForecastRollout( self, start, **kwargs )
+
+	def iter_batches( self, dates: Iterable[date], prefetch: int = 2, **kwargs ) -> "BatchPrefetcher":
+		return BatchPrefetcher( self, dates, prefetch, **kwargs )
+
+	def assemble_batch( self, d: date, **kwargs ) -> xa.Dataset:
+		if (self.storage == "zarr") and not self.day_cache.enabled:
+			time_slices: List[xa.Dataset] = [ self.load_days( d, self.days_per_batch, **kwargs ) ]
+		else:
+			bdays = date_list(d,self.days_per_batch)
+			time_slices: List[xa.Dataset] = [ self.day_cache.get( bd, lambda dl: self.load_dataset( dl, **kwargs ) ) for bd in bdays ]
+		batch: xa.Dataset = self.merge_batch( time_slices, self.constants )
+		return self.normalizer.normalize_dataset( batch ) if self.task_config.get('normalize',False) else batch
 	#	print( f"\n *********** Loaded batch, days_per_batch={self.days_per_batch}, batch_steps={self.batch_steps}, ndays={len(bdays)} *********** " )
 	#	print(f" >> times= {[str(Timestamp(t).date()) for t in self.current_batch.coords['time'].values.tolist()]} ")
 	#	for vn, dv in self.current_batch.data_vars.items():
 	#		print(f" >> {vn}{dv.dims}: {dv.shape}")
 
+	def load_samples( self, dates: List[date], **kwargs ) -> xa.Dataset:
+		sample_days: List[List[date]] = [ date_list( d, self.days_per_batch ) for d in dates ]
+		udays: List[date] = sorted( set( sum( sample_days, [] ) ) )
+		dsets: List[xa.Dataset] = [ self.day_cache.get( ud, lambda dl: self.load_dataset( dl, **kwargs ) ) for ud in udays ]
+		dpos: Dict[date,int] = { ud: iday for iday, ud in enumerate(udays) }
+		sample: xa.Dataset = dsets[0]
+		spd: int = sample.sizes['time']
+		tindex: np.ndarray = np.array( [ [ dpos[sd]*spd + it for sd in sdays for it in range(spd) ] for sdays in sample_days ] )
+		constant_vars: List[str] = self.task_config.get('constants',[])
+		alltimes: np.ndarray = np.concatenate( [ dset.coords['time'].values for dset in dsets ] )
+		dynamics: Dict[str,xa.Variable] = {}
+		for vname, dvar in sample.data_vars.items():
+			if ("time" in dvar.dims) and (vname not in constant_vars):
+				dims: Tuple[str,...] = tuple( dim for dim in dvar.dims if dim != "batch" )
+				taxis: int = dims.index("time")
+				alldata: np.ndarray = np.concatenate( [ dset.data_vars[vname].squeeze( "batch", drop=True ).values if "batch" in dvar.dims else dset.data_vars[vname].values for dset in dsets ], axis=taxis )
+				stacked: np.ndarray = np.moveaxis( np.take( alldata, tindex, axis=taxis ), taxis, 0 )
+				dynamics[vname] = xa.Variable( ("batch",) + dims, stacked, attrs=dvar.attrs )
+		coords = { cn: cv for cn, cv in sample.coords.items() if ("time" not in cv.dims) and ("batch" not in cv.dims) }
+		coords['time'] = alltimes[ tindex[0] ] - alltimes[ tindex[0][0] ]
+		coords['datetime'] = ( ("batch","time"), alltimes[ tindex ] )
+		batch: xa.Dataset = xa.Dataset( dynamics, coords )
+		constants: xa.Dataset = self.constants.copy()
+		for vname, dvar in sample.data_vars.items():
+			if "time" not in dvar.dims:
+				constants[vname] = dvar
+			elif vname in constant_vars:
+				constants[vname] = dvar.mean(dim="time", skipna=True, keep_attrs=True)
+		samples: xa.Dataset = xa.merge( [batch, constants], compat='override' )
+		return self.normalizer.normalize_dataset( samples ) if self.task_config.get('normalize',False) else samples
+
 	def get_train_data(self,  day_offset: int ) -> xa.Dataset:
-		return self.current_batch.isel( time=slice(day_offset, day_offset+self.batch_steps) )
+		train_data: xa.Dataset = self.current_batch.isel( time=slice(day_offset, day_offset+self.batch_steps) )
+		return train_data.compute() if self.lazy else train_data
+
+	@property
+	def feature_store(self) -> "FeatureStore":
+		from fmbase.source.merra2.features import FeatureStore
+		if self._feature_store is None:
+			self._feature_store = FeatureStore( feature_store_path( self.task_config['dataset_version'] ) )
+		return self._feature_store
+
+	def get_train_array(self, d: date, day_offset: int, normalize: bool = False ) -> np.ndarray:
+		sample: np.ndarray = self.feature_store.sample( d, day_offset, self.batch_steps )
+		return self.normalizer.normalize_array( sample, self.feature_store.channels ) if normalize else sample
+
+	@property
+	def normalizer(self) -> Normalizer:
+		if self._normalizer is None:
+			sndef = { sn:sn for sn in StatsAccumulator.statnames }
+			zc: str = self.task_config.get( 'coords', {} ).get( 'z', 'z' )
+			self._normalizer = Normalizer( self.norm_data, zc, self.task_config.get('statnames',sndef) )
+			robust_vars: List[str] = self.task_config.get( 'robust_scaling', [] )
+			if len(robust_vars) > 0:
+				if self.quantiles is None: raise Exception( f"FMBatch: robust_scaling set for {robust_vars} but no quantile stats have been computed" )
+				self._normalizer.set_robust( self.quantiles, robust_vars, self.task_config.get( 'robust_quantiles', (0.25,0.75) ) )
+		return self._normalizer
+
+	@property
+	def quantiles(self) -> Optional[xa.Dataset]:
+		if self._quantiles is None:
+			if os.path.exists( stats_filepath( self.task_config['dataset_version'], "quantile" ) ):
+				self._quantiles = self.load_stats( "quantile" ).load()
+		return self._quantiles
 
 	def load_dataset( self, d: date, **kwargs ):
+		if self.storage == "zarr": return self.load_days( d, 1, **kwargs )
 		version = self.task_config['dataset_version']
 		filepath =  cache_var_filepath(version, d)
 		return self._open_dataset( filepath, **kwargs)
 
+	@property
+	def zarr_store(self) -> DailyZarrStore:
+		if self._zstore is None:
+			self._zstore = open_daily_store( cache_zarr_path( self.task_config['dataset_version'] ) )
+		return self._zstore
+
+	def load_days( self, d: date, ndays: int, **kwargs ) -> xa.Dataset:
+		dset: xa.Dataset = self.zarr_store.read_days( d, ndays, **kwargs )
+		return self.rename_vars( dset if self.lazy else dset.load() )
+
+	def chunk_policy(self) -> Dict[str,int]:
+		chunks: Dict[str,int] = self.task_config.get('chunks',{})
+		dataset_coords: Dict[str,str] = { v: k for k, v in self.task_config.get('coords',{}).items() }
+		return { dataset_coords.get(cn,cn): csize for cn, csize in chunks.items() }
+
 	def _open_dataset(self, filepath: str, **kwargs) -> xa.Dataset:
-		dataset: xa.Dataset = xa.open_dataset(filepath, **kwargs)
+		if self.lazy and ('chunks' not in kwargs):
+			kwargs['chunks'] = self.chunk_policy()
+		dataset: xa.Dataset = self.file_pool.open(filepath, **kwargs)
 		return self.rename_vars(dataset)
 
 	def rename_vars( self, dataset: xa.Dataset ) -> xa.Dataset:
@@ -140,6 +297,127 @@ class FMBatch:
 		return result
 
 
+class BatchPrefetcher:
+	"""  Iterator over (date, batch) pairs for a sequence of reference dates; a background thread assembles up to 'depth' batches ahead
+	     of the consumer. Errors raised while loading are re-raised in the consumer, and close() (or leaving the context) stops the thread.  """
+	_done = object()
+
+	def __init__(self, batch: FMBatch, dates: Iterable[date], depth: int = 2, **kwargs ):
+		self.batch: FMBatch = batch
+		self.dates: Iterable[date] = dates
+		self.kwargs: Dict = kwargs
+		self._queue: queue.Queue = queue.Queue( maxsize=max(depth,1) )
+		self._stop = threading.Event()
+		self._thread = threading.Thread( target=self._produce, daemon=True )
+		self._thread.start()
+
+	def _put(self, item: Any ) -> bool:
+		while not self._stop.is_set():
+			try:
+				self._queue.put( item, timeout=0.1 )
+				return True
+			except queue.Full: pass
+		return False
+
+	def _produce(self):
+		try:
+			for d in self.dates:
+				if self._stop.is_set() or not self._put( (d, self.batch.assemble_batch( d, **self.kwargs )) ): return
+		except BaseException as err:
+			self._put( err )
+			return
+		self._put( self._done )
+
+	def __iter__(self) -> "BatchPrefetcher":
+		return self
+
+	def __next__(self) -> Tuple[date,xa.Dataset]:
+		if self._stop.is_set(): raise StopIteration
+		item = self._queue.get()
+		if item is self._done:
+			self.close()
+			raise StopIteration
+		if isinstance( item, BaseException ):
+			self.close()
+			raise item
+		return item
+
+	def close(self):
+		self._stop.set()
+		while True:
+			try: self._queue.get_nowait()
+			except queue.Empty: break
+		self._thread.join()
+
+	def __enter__(self) -> "BatchPrefetcher":
+		return self
+
+	def __exit__(self, *args ):
+		self.close()
+
+class ForecastRollout:
+	"""  Streaming loader for forecast rollouts: yields target steps lazily as the forecast advances, keeping only a small window of days
+	     resident and loading the next day in the background, so memory stays flat regardless of the eval_steps horizon.  """
+
+	def __init__(self, batch: FMBatch, start: date, **kwargs ):
+		self.batch: FMBatch = batch
+		self.start: date = start
+		self.kwargs: Dict = kwargs
+		self.input_steps: int = batch.task_config['input_steps']
+		self.eval_steps: int = kwargs.pop( 'eval_steps', batch.task_config['eval_steps'] )
+		self.steps_per_day: int = int( batch.steps_per_day )
+		self.window_days: int = max( kwargs.pop( 'window_days', 2 ), 1 )
+		self._days: OrderedDict = OrderedDict()
+		self._executor = ThreadPoolExecutor( max_workers=1 )
+		self._prefetched: Dict[date,Future] = {}
+
+	def day_index(self, step: int ) -> Tuple[date,int]:
+		return self.start + timedelta( days=step // self.steps_per_day ), step % self.steps_per_day
+
+	def _load(self, d: date ) -> xa.Dataset:
+		return self.batch.load_dataset( d, **self.kwargs ).load()
+
+	def prefetch(self, d: date ):
+		if (d not in self._days) and (d not in self._prefetched):
+			self._prefetched[d] = self._executor.submit( self._load, d )
+
+	def day(self, d: date ) -> xa.Dataset:
+		if d not in self._days:
+			future: Optional[Future] = self._prefetched.pop( d, None )
+			self._days[d] = self._load(d) if (future is None) else future.result()
+			while len(self._days) > self.window_days:
+				self._days.popitem( last=False )[1].close()
+		return self._days[d]
+
+	def steps(self, step0: int, nsteps: int ) -> xa.Dataset:
+		slices: List[xa.Dataset] = []
+		for step in range( step0, step0+nsteps ):
+			d, istep = self.day_index( step )
+			slices.append( self.day(d).isel( time=slice( istep, istep+1 ) ) )
+		return xa.concat( slices, dim="time", coords="minimal" ) if len(slices) > 1 else slices[0]
+
+	def inputs(self) -> xa.Dataset:
+		return self.batch.merge_batch( [ self.steps( 0, self.input_steps ) ], self.batch.constants )
+
+	def __iter__(self) -> Iterator[Tuple[int,xa.Dataset]]:
+		try:
+			for itarget in range( self.eval_steps ):
+				step: int = self.input_steps + itarget
+				d, istep = self.day_index( step )
+				if step + self.steps_per_day - istep < self.input_steps + self.eval_steps:
+					self.prefetch( d + timedelta(days=1) )
+				yield itarget, self.steps( step, 1 )
+		finally:
+			self.close()
+
+	def close(self):
+		for future in self._prefetched.values(): future.cancel()
+		self._prefetched.clear()
+		self._executor.shutdown( wait=True )
+		for dset in self._days.values(): dset.close()
+		self._days.clear()
+
+
 
 
 
@@ -167,8 +445,3 @@ class FMBatch:
 	# 			tsdata[vname] = varray
 	# 	return xa.Dataset( tsdata )
 
-
-
-
-
-
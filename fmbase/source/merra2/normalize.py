@@ -0,0 +1,101 @@
+import xarray as xa
+import numpy as np
+from typing import Any, Dict, List, Tuple, Type, Optional, Union, Sequence, Mapping
+
+class Normalizer:
+	"""  Precomputed per-variable (and per-level) offset/scale vectors derived from the norm data (mean, std, std_diff).  Vectors are aligned
+	     either to a variable's level dimension or to a packed channel layout, and applied in float32 with a single output allocation.  """
+
+	def __init__(self, norm_data: Dict[str, xa.Dataset], zc: str = 'z', statnames: Dict[str,str] = None ):
+		sn: Dict[str,str] = dict( mean='mean', std='std', std_diff='std_diff' ) if (statnames is None) else statnames
+		self.zc: str = zc
+		self.levels: Dict[str,Optional[np.ndarray]] = {}
+		self.offsets: Dict[str,np.ndarray] = {}
+		self.scales: Dict[str,np.ndarray] = {}
+		self.diff_scales: Dict[str,np.ndarray] = {}
+		means, stds, std_diffs = norm_data[sn['mean']], norm_data[sn['std']], norm_data.get( sn['std_diff'] )
+		for vname, mean in means.data_vars.items():
+			if vname not in stds.data_vars: continue
+			self.levels[vname] = mean.coords[zc].values if (zc in mean.dims) else None
+			self.offsets[vname] = np.atleast_1d( mean.values ).astype(np.float32)
+			self.scales[vname] = np.atleast_1d( 1.0 / stds.data_vars[vname].values ).astype(np.float32)
+			if (std_diffs is not None) and (vname in std_diffs.data_vars):
+				self.diff_scales[vname] = np.atleast_1d( 1.0 / std_diffs.data_vars[vname].values ).astype(np.float32)
+		self._channel_vectors: Dict[Tuple,Tuple[np.ndarray,np.ndarray]] = {}
+
+	def set_robust(self, quantiles: xa.Dataset, vnames: Sequence[str], qrange: Tuple[float,float] = (0.25,0.75) ):
+		"""  Scale the given variables by median and inter-quantile range (from the quantile stats product) instead of mean and std.  Only the
+		     (heavy-tailed) variables listed in the preprocess quantile_vars are sketched, so robust scaling of any other variable is refused.  """
+		unsketched: List[str] = [ vname for vname in vnames if vname not in quantiles.data_vars ]
+		if len(unsketched) > 0:
+			raise Exception( f"Normalizer: robust scaling requested for variables {unsketched} without quantile stats; add them to preprocess.quantile_vars" )
+		for vname in vnames:
+			if vname not in self.offsets: continue
+			qvar: xa.DataArray = quantiles.data_vars[vname]
+			qlo, qmed, qhi = [ np.atleast_1d( qvar.sel( quantile=q, method="nearest" ).values ) for q in (qrange[0], 0.5, qrange[1]) ]
+			spread: np.ndarray = qhi - qlo
+			self.offsets[vname] = qmed.astype(np.float32)
+			self.scales[vname] = np.where( spread > 0, 1.0 / np.where( spread > 0, spread, 1.0 ), self.scales[vname] ).astype(np.float32)
+		self._channel_vectors.clear()
+
+	def vectors(self, vname: str, diff: bool = False ) -> Optional[Tuple[np.ndarray,np.ndarray]]:
+		scales: Dict[str,np.ndarray] = self.diff_scales if diff else self.scales
+		if vname not in scales: return None
+		offset: np.ndarray = np.zeros_like( scales[vname] ) if diff else self.offsets[vname]
+		return offset, scales[vname]
+
+	def channel_vectors(self, channels: Sequence[str], diff: bool = False ) -> Tuple[np.ndarray,np.ndarray]:
+		key = ( tuple(channels), diff )
+		if key not in self._channel_vectors:
+			offset, scale = np.zeros( len(channels), np.float32 ), np.ones( len(channels), np.float32 )
+			for ic, channel in enumerate( channels ):
+				vname, _, level = channel.partition(".")
+				vectors = self.vectors( vname, diff )
+				if vectors is None: continue
+				ilev: int = 0 if (level == "") else int( np.argmin( np.abs( self.levels[vname] - float(level) ) ) )
+				offset[ic], scale[ic] = vectors[0][ilev], vectors[1][ilev]
+			self._channel_vectors[key] = ( offset, scale )
+		return self._channel_vectors[key]
+
+	def normalize_array(self, array: np.ndarray, channels: Sequence[str], diff: bool = False ) -> np.ndarray:
+		offset, scale = self.channel_vectors( channels, diff )
+		result: np.ndarray = np.subtract( array, offset, dtype=np.float32 )
+		return np.multiply( result, scale, out=result )
+
+	def denormalize_array(self, array: np.ndarray, channels: Sequence[str], diff: bool = False ) -> np.ndarray:
+		offset, scale = self.channel_vectors( channels, diff )
+		result: np.ndarray = np.divide( array, scale, dtype=np.float32 )
+		return np.add( result, offset, out=result )
+
+	def var_vectors(self, vname: str, dvar: xa.DataArray, diff: bool = False ) -> Optional[Tuple[np.ndarray,np.ndarray]]:
+		vectors = self.vectors( vname, diff )
+		if vectors is None: return None
+		offset, scale = vectors
+		if self.zc in dvar.dims:
+			ilevs: np.ndarray = np.array( [ np.argmin( np.abs( self.levels[vname] - lev ) ) for lev in dvar.coords[self.zc].values ] )
+			shape = [ 1 ] * dvar.ndim
+			shape[ dvar.get_axis_num(self.zc) ] = ilevs.size
+			return offset[ilevs].reshape(shape), scale[ilevs].reshape(shape)
+		return offset[0], scale[0]
+
+	def normalize_dataset(self, dset: xa.Dataset, diff: bool = False ) -> xa.Dataset:
+		for vname, dvar in list( dset.data_vars.items() ):
+			vectors = self.var_vectors( vname, dvar, diff )
+			if vectors is None: continue
+			if isinstance( dvar.data, np.ndarray ):
+				result: np.ndarray = np.subtract( dvar.values, vectors[0], dtype=np.float32 )
+				dset[vname] = dvar.copy( data=np.multiply( result, vectors[1], out=result ) )
+			else:
+				dset[vname] = dvar.copy( data=( (dvar.data - vectors[0]) * vectors[1] ).astype(np.float32) )
+		return dset
+
+	def denormalize_dataset(self, dset: xa.Dataset, diff: bool = False ) -> xa.Dataset:
+		for vname, dvar in list( dset.data_vars.items() ):
+			vectors = self.var_vectors( vname, dvar, diff )
+			if vectors is None: continue
+			if isinstance( dvar.data, np.ndarray ):
+				result: np.ndarray = np.divide( dvar.values, vectors[1], dtype=np.float32 )
+				dset[vname] = dvar.copy( data=np.add( result, vectors[0], out=result ) )
+			else:
+				dset[vname] = dvar.copy( data=( dvar.data / vectors[1] + vectors[0] ).astype(np.float32) )
+		return dset
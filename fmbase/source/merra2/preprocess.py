@@ -1,13 +1,17 @@
 import xarray as xa, pandas as pd
 import numpy as np
 from fmbase.util.config import cfg
-from typing import List, Union, Tuple, Optional, Dict, Type, Any, Sequence, Mapping
-import glob, sys, os, time, traceback
+from typing import List, Union, Tuple, Optional, Dict, Type, Any, Sequence, Mapping, Iterator, Set, Callable
+import glob, sys, os, time, copy, pickle, traceback
 from fmbase.util.ops import fmbdir
-from fmbase.util.dates import skw, dstr
+from fmbase.util.dates import skw, dstr, date_range
 from datetime import date
 from xarray.core.resample import DataArrayResample
-from fmbase.util.ops import get_levels_config, increasing, replace_nans
+from fmbase.util.ops import get_levels_config, increasing, GapFiller
+from fmbase.util.stats import Moments, LogHistogram
+from fmbase.util.regrid import Regridder, LevelInterpolator
+from fmbase.io.zstore import DailyZarrStore
+from fmbase.util.filelock import FileLock
 np.set_printoptions(precision=3, suppress=False, linewidth=150)
 from enum import Enum
 
@@ -18,9 +22,6 @@ _AVG_DAY_PER_YEAR = 365.24219
 AVG_SEC_PER_YEAR = SEC_PER_DAY * _AVG_DAY_PER_YEAR
 def nnan(varray: xa.DataArray) -> int: return np.count_nonzero(np.isnan(varray.values))
 
-def nodata_test(vname: str, varray: xa.DataArray, d: date):
-    num_nodata = nnan(varray)
-    assert num_nodata == 0, f"ERROR: {num_nodata} Nodata values found in variable {vname} for date {d}"
 def nmissing(varray: xa.DataArray) -> int:
     mval = varray.attrs.get('fmissing_value',-9999)
     return np.count_nonzero(varray.values == mval)
@@ -41,33 +42,108 @@ class QType(Enum):
     Intensive = 'intensive'
     Extensive = 'extensive'
 
+class QCReport:
+
+    def __init__(self, varname: str, size: int, nnan: int, nmissing: int, nfilled: int, nremaining: int, moments: Optional[Moments] = None ):
+        self.varname = varname
+        self.moments = moments
+        self.size = size
+        self.nnan = nnan
+        self.nmissing = nmissing
+        self.nfilled = nfilled
+        self.nremaining = nremaining
+
+    @property
+    def passed(self) -> bool:
+        return self.nremaining == 0
+
+    def test(self, d: date):
+        assert self.passed, f"ERROR: {self.nremaining} Nodata values found in variable {self.varname} for date {d}"
+
+    def __repr__(self) -> str:
+        return f"QC[{self.varname}]: nan={self.nnan}, missing={self.nmissing}, filled={self.nfilled}/{self.size}, remaining={self.nremaining}"
+
 class StatsEntry:
 
     def __init__(self, varname: str ):
-        self._stats: Dict[str,List[xa.DataArray]] = {}
+        self._moments: Dict[str,Moments] = {}
+        self._sketch: Optional[LogHistogram] = None
+        self._edges: Dict[str,Any] = dict( head=None, tail=None, tstep=None )
+        self._tail_data: Optional[xa.DataArray] = None
         self._varname = varname
 
+    def __getstate__(self) -> Dict:
+        state: Dict = self.__dict__.copy()
+        state['_tail_data'] = None
+        return state
+
     def merge(self, entry: "StatsEntry"):
-        for statname, mvars in entry._stats.items():
-            for mvar in mvars:
-                self.add( statname, mvar )
+        for field, moments in entry._moments.items():
+            self.add( field, moments )
+        if entry.sketch is not None:
+            self.add_sketch( entry.sketch )
 
-    def add(self, statname: str, mvar: xa.DataArray, weight: int = None ):
-        if weight is not None: mvar.attrs['stat_weight'] = float(weight)
-        elist = self._stats.setdefault(statname,[])
-        elist.append( mvar )
-#        print( f" SSS: Add stats entry[{self._varname}.{statname}]: dims={mvar.dims}, shape={mvar.shape}, size={mvar.size}, ndim={mvar.ndim}, weight={weight}")
-#        if mvar.ndim > 0:  print( f"      --> sample: {mvar.values[0:8]}")
-#        else:              print( f"      --> sample: {mvar.values}")
+    @property
+    def sketch(self) -> Optional[LogHistogram]:
+        return getattr( self, '_sketch', None )
+
+    def add_sketch(self, sketch: LogHistogram ):
+        if self.sketch is None: self._sketch = copy.deepcopy(sketch)
+        else:                   self._sketch.merge( sketch )
+
+    @property
+    def edges(self) -> Dict[str,Any]:
+        return getattr( self, '_edges', dict( head=None, tail=None, tstep=None ) )
+
+    def set_edges(self, head: Optional[np.datetime64], tail: Optional[np.datetime64], tstep: Optional[np.timedelta64] ):
+        self._edges = dict( head=head, tail=tail, tstep=tstep )
+
+    @property
+    def tail_data(self) -> Optional[xa.DataArray]:
+        return getattr( self, '_tail_data', None )
 
-    def entries( self, statname: str ) -> Optional[List[xa.DataArray]]:
-        return self._stats.get(statname)
+    @tail_data.setter
+    def tail_data(self, tail: Optional[xa.DataArray] ):
+        self._tail_data = tail
+
+    @property
+    def varname(self) -> Optional[str]:
+        return getattr( self, '_varname', None )
+
+    def diff_products(self) -> List[str]:
+        return [ field.partition("_")[2] for field in self.fields if (field == "diff") or field.startswith("diff_") ]
+
+    def add(self, field: str, moments: Moments ):
+        current: Optional[Moments] = self._moments.get(field)
+        if current is None: self._moments[field] = copy.deepcopy(moments)
+        else:               current.merge( moments )
+
+    @property
+    def fields(self) -> List[str]:
+        return list( self._moments.keys() )
+
+    def moments( self, field: str ) -> Optional[Moments]:
+        return self._moments.get(field)
+
+    def stat( self, statname: str ) -> Optional[xa.DataArray]:
+        if statname == "quantile":
+            return None if (self.sketch is None) else self.sketch.quantiles( StatsAccumulator.quantiles )
+        moment, _, field = statname.partition("_")
+        moments: Optional[Moments] = self._moments.get(field)
+        return None if (moments is None) else moments.stat(moment)
 
 class StatsAccumulator:
     statnames = ["mean", "std", "std_diff"]
+    products = ["area", "band"]
+    quantiles = [ 0.0001, 0.001, 0.01, 0.02, 0.05, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 0.98, 0.99, 0.999, 0.9999 ]
+    sketch_vars = [ "PRECLS", "TQI", "TQL" ]
 
-    def __init__(self):
+    def __init__(self, area_weighted: bool = False, band_width: float = 0.0, sketch_vars: Sequence[str] = () ):
         self._entries: Dict[str, StatsEntry] = {}
+        self.step_loader: Optional[Callable[[str,np.datetime64],Optional[xa.DataArray]]] = None
+        self.area_weighted: bool = area_weighted
+        self.band_width: float = band_width
+        self.sketch_vars: List[str] = list( sketch_vars )
 
     @property
     def entries(self) -> Dict[str, StatsEntry]:
@@ -80,46 +156,166 @@ class StatsAccumulator:
     def varnames(self):
         return self._entries.keys()
 
-    def add_entry(self, varname: str, mvar: xa.DataArray):
+    def merge(self, stats: "StatsAccumulator"):
+        for varname, new_entry in stats.entries.items():
+            entry: StatsEntry = self.entry(varname)
+            self.stitch( entry, new_entry )
+            entry.merge( new_entry )
+
+    @classmethod
+    def reduce(cls, stats: List["StatsAccumulator"], step_loader: Callable[[str,np.datetime64],Optional[xa.DataArray]] = None ) -> "StatsAccumulator":
+        partials: List[StatsAccumulator] = list(stats)
+        while len(partials) > 1:
+            for ip in range( 0, len(partials)-1, 2 ):
+                partials[ip].step_loader = step_loader
+                partials[ip].merge( partials[ip+1] )
+            partials = partials[::2]
+        return partials[0] if len(partials) > 0 else StatsAccumulator()
+
+    @classmethod
+    def moment_dims(cls, dims: Sequence[str] ) -> List[str]:
+        return ['time', 'y', 'x'] if ("time" in dims) else ['y', 'x']
+
+    def add_entry(self, varname: str, mvar: xa.DataArray, nan_free: bool = False, moments: Optional[Moments] = None ):
         istemporal = "time" in mvar.dims
         first_entry = varname not in self._entries
-        dims = ['time', 'y', 'x'] if istemporal else ['y', 'x']
-        weight =  mvar.shape[0] if istemporal else 1
+        dims = self.moment_dims( mvar.dims )
         if istemporal or first_entry:
-            mean: xa.DataArray = mvar.mean(dim=dims, skipna=True, keep_attrs=True)
-            std: xa.DataArray = mvar.std(dim=dims, skipna=True, keep_attrs=True)
-            entry: StatsEntry= self.entry( varname)
-            entry.add( "mean", mean, weight )
-            entry.add("std",  std, weight )
+            entry: StatsEntry = self.entry( varname)
+            products: List[str] = self.field_products()
+            weights: Optional[xa.DataArray] = self.area_weights( mvar ) if (len(products) > 1) else None
+            for product in products:
+                pmoments: Optional[Moments] = moments if (product == "") else None
+                entry.add( product, pmoments if (pmoments is not None) else self.field_moments( product, mvar, dims, nan_free, weights ) )
             if istemporal:
-                mvar_diff: xa.DataArray = mvar.diff("time")
-                weight = mvar.shape[0]
-                mean_diff: xa.DataArray = mvar_diff.mean( dim=dims, skipna=True, keep_attrs=True )
-                std_diff: xa.DataArray  = mvar_diff.std(  dim=dims, skipna=True, keep_attrs=True )
-                entry: StatsEntry = self.entry( varname)
-                entry.add("mean_diff", mean_diff, weight )
-                entry.add("std_diff",  std_diff,  weight )
-                times: List[str] = [str(pd.Timestamp(dt64)) for dt64 in mvar.coords['time'].values.tolist()]
+                self.add_diff( entry, mvar.diff("time"), nan_free, products )
+                self.add_edges( entry, varname, mvar )
+            if varname in self.sketch_vars:
+                entry.add_sketch( LogHistogram.from_array( mvar, dims ) )
+
+    def field_products(self) -> List[str]:
+        return [ "" ] + ( [ "area" ] if self.area_weighted else [] ) + ( [ "band" ] if (self.band_width > 0) else [] )
+
+    def add_diff(self, entry: StatsEntry, mvar_diff: xa.DataArray, nan_free: bool, products: List[str] ):
+        weights: Optional[xa.DataArray] = self.area_weights( mvar_diff ) if (len(products) > 1) else None
+        for product in products:
+            dfield: str = "diff" if (product == "") else f"diff_{product}"
+            current: Optional[Moments] = entry.moments( dfield )
+            band_width: float = self.band_width if (current is None) else current.attrs.get( 'lat_band_width', self.band_width )
+            entry.add( dfield, self.field_moments( product, mvar_diff, ['time', 'y', 'x'], nan_free, weights, band_width ) )
+
+    def add_edges(self, entry: StatsEntry, varname: str, mvar: xa.DataArray ):
+        """  Record the first and last time stamps of the variable so that the diff across the following file boundary (seam) can be
+             counted, either when the next day is added to this accumulator or when partials are stitched at reduction time.  Only the
+             time stamps are persisted: the boundary steps are read back from the processed day files when a seam is stitched.  """
+        times: np.ndarray = mvar.coords['time'].values
+        edges: Dict[str,Any] = entry.edges
+        tstep: Optional[np.timedelta64] = (times[1] - times[0]) if (times.size > 1) else edges['tstep']
+        if self.consecutive( edges['tail'], times[0], tstep ):
+            tail: Optional[xa.DataArray] = entry.tail_data
+            if (tail is None) or (tail.coords['time'].values[0] != edges['tail']): tail = self.load_step( varname, edges['tail'] )
+            seam: Optional[xa.DataArray] = self.seam( tail, mvar.isel( time=[0] ) )
+            if seam is not None:
+                self.add_diff( entry, seam, False, entry.diff_products() )
+                entry.set_edges( edges['head'], times[-1], tstep )
+                entry.tail_data = mvar.isel( time=[-1] )
+                return
+        entry.set_edges( times[0] if (edges['head'] is None) else edges['head'], times[-1], tstep )
+        entry.tail_data = mvar.isel( time=[-1] )
+
+    def load_step(self, varname: str, time: np.datetime64 ) -> Optional[xa.DataArray]:
+        return None if (self.step_loader is None) else self.step_loader( varname, time )
+
+    @classmethod
+    def consecutive(cls, tail: Optional[np.datetime64], head: Optional[np.datetime64], tstep: Optional[np.timedelta64] ) -> bool:
+        return (tail is not None) and (head is not None) and (tstep is not None) and (tail + tstep == head)
+
+    @classmethod
+    def seam(cls, tail: Optional[xa.DataArray], head: Optional[xa.DataArray] ) -> Optional[xa.DataArray]:
+        if (tail is None) or (head is None): return None
+        return head.copy( data=head.values.astype(np.float64) - tail.transpose( *head.dims ).values )
+
+    def stitch(self, entry: StatsEntry, other: StatsEntry ):
+        edges, oedges = entry.edges, other.edges
+        tstep: Optional[np.timedelta64] = edges['tstep'] if (edges['tstep'] is not None) else oedges['tstep']
+        products: List[str] = sorted( set( entry.diff_products() ) | set( other.diff_products() ) )
+        for first, second in ( (edges, oedges), (oedges, edges) ):
+            if self.consecutive( first['tail'], second['head'], tstep ):
+                varname: str = entry.varname if (entry.varname is not None) else other.varname
+                seam: Optional[xa.DataArray] = self.seam( self.load_step( varname, first['tail'] ), self.load_step( varname, second['head'] ) )
+                if seam is not None:
+                    self.add_diff( entry, seam, False, products )
+                    entry.set_edges( first['head'], second['tail'], tstep )
+                    return
+        heads: List[np.datetime64] = [ h for h in (edges['head'], oedges['head']) if h is not None ]
+        tails: List[np.datetime64] = [ t for t in (edges['tail'], oedges['tail']) if t is not None ]
+        entry.set_edges( min(heads) if len(heads) > 0 else None, max(tails) if len(tails) > 0 else None, tstep )
+
+    def carry(self) -> "StatsAccumulator":
+        carried = StatsAccumulator( self.area_weighted, self.band_width, self.sketch_vars )
+        carried.step_loader = self.step_loader
+        for varname, entry in self._entries.items():
+            if entry.edges['tail'] is not None:
+                centry: StatsEntry = carried.entry( varname )
+                centry.set_edges( None, entry.edges['tail'], entry.edges['tstep'] )
+                centry.tail_data = entry.tail_data
+        return carried
+
+    @classmethod
+    def area_weights(cls, mvar: xa.DataArray ) -> xa.DataArray:
+        lats: np.ndarray = mvar.coords['y'].values
+        return xa.DataArray( np.clip( np.cos( np.deg2rad(lats) ), 0.0, None ), dims=['y'] )
+
+    def field_moments(self, product: str, mvar: xa.DataArray, dims: List[str], nan_free: bool, weights: Optional[xa.DataArray], band_width: float = None ) -> Moments:
+        if product == "":     return Moments.from_array( mvar, dims, nan_free )
+        if product == "area": return Moments.from_array( mvar, dims, nan_free, weights )
+        band_width = self.band_width if (band_width is None) else band_width
+        moments: Moments = Moments.from_array( mvar, [ d for d in dims if d != 'y' ], nan_free, weights )
+        lats: np.ndarray = mvar.coords['y'].values
+        bands: np.ndarray = np.clip( np.floor( (lats + 90.0) / band_width ), 0, np.ceil( 180.0 / band_width ) - 1 )
+        centers: np.ndarray = -90.0 + ( np.unique(bands) + 0.5 ) * band_width
+        moments = moments.group( 'y', bands, 'lat_band', dict( lat_band=centers ) )
+        moments.attrs = dict( moments.attrs, lat_band_width=band_width )
+        return moments
+
+    def product_statnames(self) -> List[str]:
+        fields: Set[str] = { field for entry in self._entries.values() for field in entry.fields }
+        statnames: List[str] = [ f"{sn}_{product}" for product in self.products if product in fields for sn in self.statnames ]
+        if any( entry.sketch is not None for entry in self._entries.values() ): statnames.append( "quantile" )
+        return statnames
 
     def accumulate(self, statname: str ) -> xa.Dataset:
         accum_stats = {}
         coords = {}
         for varname in self.varnames:
-            varstats: StatsEntry = self._entries[varname]
-            entries: Optional[List[xa.DataArray]] = varstats.entries( statname )
-            squared = statname.startswith("std")
-            if entries is not None:
-                esum, wsum = None, 0
-                for entry in entries:
-                    w = entry.attrs['stat_weight']
-                    eterm = w*entry*entry if squared else w*entry
-                    esum = eterm if (esum is None) else esum + eterm
-                    wsum = wsum + w
-                astat = np.sqrt( esum/wsum ) if squared else esum/wsum
+            astat: Optional[xa.DataArray] = self._entries[varname].stat( statname )
+            if astat is not None:
                 accum_stats[varname] = astat
                 coords.update( astat.coords )
         return xa.Dataset( accum_stats, coords )
 
+    def dump( self, filepath: str ):
+        os.makedirs(os.path.dirname(filepath), mode=0o777, exist_ok=True)
+        tmp_path = f"{filepath}.{os.getpid()}.tmp"
+        with open( tmp_path, "wb" ) as f:
+            pickle.dump( self._entries, f, protocol=pickle.HIGHEST_PROTOCOL )
+        os.replace( tmp_path, filepath )
+
+    @classmethod
+    def load( cls, filepath: str ) -> "StatsAccumulator":
+        stats = StatsAccumulator()
+        with open( filepath, "rb" ) as f:
+            stats._entries = pickle.load( f )
+        return stats
+
+    @classmethod
+    def load_reduced( cls, filepaths: List[str], step_loader: Callable[[str,np.datetime64],Optional[xa.DataArray]] = None ) -> "StatsAccumulator":
+        stats = StatsAccumulator()
+        stats.step_loader = step_loader
+        for filepath in filepaths:
+            stats.merge( cls.load( filepath ) )
+        return stats
+
     def save( self, statname: str, filepath: str ):
         os.makedirs(os.path.dirname(filepath), mode=0o777, exist_ok=True)
         accum_stats: xa.Dataset = self.accumulate(statname)
@@ -149,14 +345,58 @@ class MERRA2DataProcessor:
         self.xext, self.yext = cfg().preprocess.get('xext'), cfg().preprocess.get('yext')
         self.xres, self.yres = cfg().preprocess.get('xres'), cfg().preprocess.get('yres')
         self.levels: Optional[np.ndarray] = get_levels_config( cfg().preprocess )
-        self.tstep = str(cfg().preprocess.data_timestep) + "H"
+        self.tstep = pd.Timedelta( hours=cfg().preprocess.data_timestep )
         self.month_range = cfg().preprocess.get('month_range',[0,12,1])
         self.vars: Dict[str, List[str]] = cfg().preprocess.vars
         self.dmap: Dict = cfg().preprocess.dims
         self.corder = ['time','z','y','x']
         self.var_file_template =  cfg().platform.dataset_files
         self.const_file_template =  cfg().platform.constant_file
-        self.stats = StatsAccumulator()
+        self.storage: str = cfg().preprocess.get('storage','netcdf')
+        self._zstore: Optional[DailyZarrStore] = None
+        self.gap_filler = GapFiller()
+        self.sample_instantaneous: bool = cfg().preprocess.get('sample_instantaneous', False)
+        self._step_dsets: Dict[str,xa.Dataset] = {}
+        self.stats = self.new_stats()
+
+    def new_stats(self) -> StatsAccumulator:
+        sketch_vars: List[str] = list( cfg().preprocess.get('quantile_vars', StatsAccumulator.sketch_vars) ) if cfg().preprocess.get('quantile_sketch', False) else []
+        stats = StatsAccumulator( cfg().preprocess.get('area_weighted_stats', False), cfg().preprocess.get('lat_band_width', 0.0), sketch_vars )
+        stats.step_loader = self.load_step
+        return stats
+
+    def load_step(self, varname: str, time: np.datetime64 ) -> Optional[xa.DataArray]:
+        from .model import cache_var_filepath
+        d: date = pd.Timestamp( time ).date()
+        try:
+            if self.storage == "zarr":
+                dset: xa.Dataset = self.zarr_store.read_days( d )
+            else:
+                filepath: str = cache_var_filepath( cfg().preprocess.version, d )
+                if filepath not in self._step_dsets:
+                    if not os.path.exists( filepath ): return None
+                    while len( self._step_dsets ) > 1: self._step_dsets.pop( next(iter(self._step_dsets)) ).close()
+                    self._step_dsets[filepath] = xa.open_dataset( filepath, cache=False )
+                dset: xa.Dataset = self._step_dsets[filepath]
+        except Exception as err:
+            print( f" ** Unable to read time step {time} of {varname}: {err}")
+            return None
+        if (varname not in dset.data_vars) or (time not in dset.coords['time'].values): return None
+        return dset.data_vars[varname].sel( time=[time] ).load()
+
+    @property
+    def zarr_store(self) -> DailyZarrStore:
+        from .model import cache_zarr_path
+        if self._zstore is None:
+            y0, y1 = cfg().preprocess.year_range
+            start: date = date(y0,1,1)
+            self._zstore = DailyZarrStore( cache_zarr_path(cfg().preprocess.version), start, (date(y1,1,1)-start).days, cfg().preprocess.data_timestep )
+        return self._zstore
+
+    def day_cached(self, d: date ) -> bool:
+        from .model import cache_var_filepath
+        if self.storage == "zarr": return False
+        return os.path.exists( cache_var_filepath(cfg().preprocess.version, d) )
 
     @classmethod
     def get_qtype( cls, vname: str) -> QType:
@@ -164,15 +404,13 @@ class MERRA2DataProcessor:
         return QType.Extensive if vname in extensive_vars else QType.Intensive
 
     def merge_stats( self, stats: List[StatsAccumulator] = None ):
-        for stats_accum in ([] if stats is None else stats):
-            for varname, new_entry in stats_accum.entries.items():
-                entry: StatsEntry = self.stats.entry(varname)
-                entry.merge( new_entry )
+        if stats is not None:
+            self.stats = StatsAccumulator.reduce( [self.stats] + list(stats), self.load_step )
 
     def save_stats(self, ext_stats: List[StatsAccumulator]=None ):
         from fmbase.source.merra2.model import stats_filepath
         self.merge_stats( ext_stats )
-        for statname in self.stats.statnames:
+        for statname in self.stats.statnames + self.stats.product_statnames():
             filepath = stats_filepath( cfg().preprocess.version, statname )
             self.stats.save( statname, filepath )
 
@@ -183,7 +421,7 @@ class MERRA2DataProcessor:
         assert "{month}" in self.var_file_template, "{month} field missing from platform.cov_files parameter"
         for collection, vlist in self.vars.items():
             if collection.startswith("const"): dset_template: str = self.const_file_template.format( collection=collection )
-            else:                              dset_template: str = self.var_file_template.format(   collection=collection, year=year, month=f"{month + 1:0>2}")
+            else:                              dset_template: str = self.var_file_template.format(   collection=collection, year=year, month=f"{month + 1:0>2}", day="*")
             dset_paths: str = f"{dsroot}/{dset_template}"
             gfiles: List[str] = glob.glob(dset_paths)
 #            print( f" ** M{month}: Found {len(gfiles)} files for glob {dset_paths}, template={self.var_file_template}, root dir ={dsroot}")
@@ -204,55 +442,119 @@ class MERRA2DataProcessor:
                 dset_list[collection] = (file_path, vlist)
         return dset_files, const_files
 
-    def process_day(self, d: date, **kwargs):
-        from .model import cache_var_filepath, cache_const_filepath
+    def process_day(self, d: date, **kwargs) -> bool:
+        from .model import cache_var_filepath
         reprocess: bool = kwargs.pop('reprocess', False)
         cache_fvpath: str = cache_var_filepath(cfg().preprocess.version, d)
         os.makedirs(os.path.dirname(cache_fvpath), mode=0o777, exist_ok=True)
-        if (not os.path.exists(cache_fvpath)) or reprocess:
-            cache_fcpath: str = cache_const_filepath(cfg().preprocess.version)
+        if (not self.day_cached(d)) or reprocess:
             dset_files, const_files = self.get_daily_files(d)
             ncollections = len(dset_files.keys())
             if ncollections == 0:
                 print( f"No collections found for date {d}")
+                return False
             else:
                 collection_dsets: List[xa.Dataset] = []
                 for collection, (file_path, dvars) in dset_files.items():
                     collection_dset: xa.Dataset = self.load_collection(  collection, file_path, dvars, d, **kwargs)
                     if collection_dset is not None: collection_dsets.append(collection_dset)
-                if len(collection_dsets) > 0:
-                    xa.merge(collection_dsets).to_netcdf(cache_fvpath, format="NETCDF4")
-                    print(f" >> Saving collection data for {d} to file '{cache_fvpath}'")
-                else:
-                    print(f" >> No collection data found for date {d}")
-
-                if not os.path.exists(cache_fcpath):
-                    const_dsets: List[xa.Dataset] = []
-                    for collection, (file_path, dvars) in const_files.items():
-                        collection_dset: xa.Dataset = self.load_collection(  collection, file_path, dvars, d, isconst=True, **kwargs)
-                        if collection_dset is not None: const_dsets.append( collection_dset )
-                    if len( const_dsets ) > 0:
-                        xa.merge(const_dsets).to_netcdf(cache_fcpath, format="NETCDF4", mode="w")
-                        print(f" >> Saving const data to file '{cache_fcpath}'")
-                    else:
-                        print(f" >> No constant data found")
+                self.save_day( d, collection_dsets, cache_fvpath )
+                self.process_constants( const_files, d, **kwargs )
+                return len(collection_dsets) > 0
         else:
             print( f" ** Skipping date {d} due to existence of processed file '{cache_fvpath}'")
+            return True
+
+    def process_month(self, year: int, month: int, days: List[date] = None, **kwargs) -> Iterator[date]:
+        from .model import cache_var_filepath
+        reprocess: bool = kwargs.pop('reprocess', False)
+        monthly_files: Dict[str, Tuple[List[str],List[str]]] = self.get_monthly_files( year, month-1 )
+        dset_files  = { c: (sorted(files), dvars) for c, (files, dvars) in monthly_files.items() if (not c.startswith("const")) and (len(files) > 0) }
+        const_files = { c: (files[0], dvars)      for c, (files, dvars) in monthly_files.items() if c.startswith("const") and (len(files) > 0) }
+        if days is None:
+            days = date_range( date(year, month, 1), date(year + month // 12, month % 12 + 1, 1) )
+        if len(dset_files) == 0:
+            print( f"No collections found for month {year}-{month}")
+            return
+        mdsets: Dict[str, Tuple[xa.Dataset,List[str]]] = {}
+        try:
+            for collection, (files, dvars) in dset_files.items():
+                mdset: xa.Dataset = xa.open_mfdataset( files, combine="nested", concat_dim="time", data_vars="minimal", coords="minimal", compat="override", cache=False,
+                                                       preprocess=lambda ds, dvars=dvars: ds[list(dvars)] )
+                mdsets[collection] = ( mdset, dvars )
+            for d in days:
+                cache_fvpath: str = cache_var_filepath(cfg().preprocess.version, d)
+                os.makedirs(os.path.dirname(cache_fvpath), mode=0o777, exist_ok=True)
+                if self.day_cached(d) and not reprocess:
+                    print( f" ** Skipping date {d} due to existence of processed file '{cache_fvpath}'")
+                    yield d
+                    continue
+                collection_dsets: List[xa.Dataset] = []
+                for collection, (mdset, dvars) in mdsets.items():
+                    day_dset: xa.Dataset = mdset.sel( time=slice( d.isoformat(), d.isoformat() ) )
+                    if day_dset.sizes['time'] > 0:
+                        collection_dset: xa.Dataset = self.process_collection( collection, day_dset, dvars, d, **kwargs )
+                        if collection_dset is not None: collection_dsets.append(collection_dset)
+                if len(collection_dsets) == 0:
+                    print( f"No collection data found for date {d}")
+                    continue
+                self.save_day( d, collection_dsets, cache_fvpath )
+                self.process_constants( const_files, d, **kwargs )
+                yield d
+        finally:
+            for mdset, _ in mdsets.values(): mdset.close()
+
+    def save_day(self, d: date, collection_dsets: List[xa.Dataset], cache_fvpath: str ):
+        if len(collection_dsets) > 0:
+            if self.storage == "zarr":
+                self.zarr_store.write_day( d, xa.merge(collection_dsets) )
+                print(f" >> Saving collection data for {d} to zarr store '{self.zarr_store.path}'")
+            else:
+                xa.merge(collection_dsets).to_netcdf(cache_fvpath, format="NETCDF4")
+                print(f" >> Saving collection data for {d} to file '{cache_fvpath}'")
+        else:
+            print(f" >> No collection data found for date {d}")
+
+    def build_constants(self, d: date, **kwargs ):
+        dset_files, const_files = self.get_daily_files(d)
+        self.process_constants( const_files, d, **kwargs )
+
+    def process_constants(self, const_files: Dict[str, Tuple[str, List[str]]], d: date, **kwargs ):
+        from .model import cache_const_filepath
+        cache_fcpath: str = cache_const_filepath(cfg().preprocess.version)
+        if os.path.exists(cache_fcpath): return
+        with FileLock( f"{cache_fcpath}.lock" ):
+            if os.path.exists(cache_fcpath): return
+            const_dsets: List[xa.Dataset] = []
+            for collection, (file_path, dvars) in const_files.items():
+                collection_dset: xa.Dataset = self.load_collection(  collection, file_path, dvars, d, isconst=True, **kwargs)
+                if collection_dset is not None: const_dsets.append( collection_dset )
+            if len( const_dsets ) > 0:
+                tmp_path = f"{cache_fcpath}.{os.getpid()}.tmp"
+                xa.merge(const_dsets).to_netcdf(tmp_path, format="NETCDF4", mode="w")
+                os.replace( tmp_path, cache_fcpath )
+                print(f" >> Saving const data to file '{cache_fcpath}'")
+            else:
+                print(f" >> No constant data found")
 
     def load_collection(self, collection: str, file_path: str, dvars: List[str], d: date, **kwargs) -> Optional[xa.Dataset]:
-        dset: xa.Dataset = xa.open_dataset(file_path)
+        dset: xa.Dataset = xa.open_dataset( file_path, cache=False )[list(dvars)]
+        result: Optional[xa.Dataset] = self.process_collection( collection, dset, dvars, d, **kwargs )
+        dset.close()
+        return result
+
+    def process_collection(self, collection: str, dset: xa.Dataset, dvars: List[str], d: date, **kwargs) -> Optional[xa.Dataset]:
         isconst: bool = kwargs.pop( 'isconst', False )
         dset_attrs: Dict = dict(collection=collection, **dset.attrs, **kwargs)
         mvars: Dict[str,xa.DataArray] = {}
         for dvar in dvars:
             darray: xa.DataArray = dset.data_vars[dvar]
             qtype: QType = self.get_qtype(dvar)
-            mvar: xa.DataArray = self.subsample( darray, dset_attrs, qtype, isconst )
-            self.stats.add_entry(dvar, mvar)
-            nodata_test( dvar, mvar, d)
-            print(f" ** Processing variable {dvar}{mvar.dims}: {mvar.shape} for {d}")
+            mvar, report = self.subsample( darray, dset_attrs, qtype, isconst )
+            report.test( d )
+            self.stats.add_entry(dvar, mvar, nan_free=True, moments=report.moments)
+            print(f" ** Processing variable {dvar}{mvar.dims}: {mvar.shape} for {d}, {report}")
             mvars[dvar] = mvar
-        dset.close()
         if len( mvars ) > 0:
             result = xa.Dataset(mvars)
             if not isconst:
@@ -318,6 +620,33 @@ class MERRA2DataProcessor:
         return subsample_coords
 
 
+    def horizontal_window(self, varray: xa.DataArray, scoords: Dict[str,Any] ) -> xa.DataArray:
+        window: Dict[str,slice] = {}
+        for cn in ['x','y']:
+            cv = scoords.get(cn)
+            if (cv is not None) and not isinstance(cv, slice):
+                src: np.ndarray = varray.coords[cn].values
+                if increasing(src):
+                    i0: int = max( int(np.searchsorted( src, cv.min(), side='right' )) - 1, 0 )
+                    i1: int = min( int(np.searchsorted( src, cv.max(), side='left' )) + 1, src.size )
+                    if (i1 - i0) < src.size: window[cn] = slice( i0, i1 )
+        return varray.isel( **window ) if len(window) > 0 else varray
+
+    def sample_times(self, varray: xa.DataArray ) -> xa.DataArray:
+        hours: np.ndarray = varray.coords['time'].dt.hour.values
+        return varray.isel( time=np.nonzero( hours % cfg().preprocess.data_timestep == 0 )[0] )
+
+    def regrid(self, varray: xa.DataArray, scoords: Dict[str,Any] ) -> xa.DataArray:
+        hcoords: Dict[str,Any] = { cn: scoords[cn] for cn in ['x','y'] if cn in scoords }
+        hslices: Dict[str,slice] = { cn: cv for cn, cv in hcoords.items() if isinstance(cv, slice) }
+        if len(hslices) > 0:
+            varray = varray.sel( **hslices )
+        dst: Dict[str,np.ndarray] = { cn: cv for cn, cv in hcoords.items() if not isinstance(cv, slice) }
+        if len(dst) == 0: return varray
+        src: Dict[str,np.ndarray] = { cn: varray.coords[cn].values for cn in dst.keys() }
+        regridder: Regridder = Regridder.get( src, dst, f"{fmbdir('cache')}/regrid" )
+        return regridder( varray )
+
     def subsample_1d(self, variable: xa.DataArray, global_attrs: Dict ) -> xa.DataArray:
         cmap: Dict[str,str] = { cn0:cn1 for (cn0,cn1) in self.dmap.items() if cn0 in list(variable.coords.keys()) }
         varray: xa.DataArray = variable.rename(**cmap)
@@ -334,24 +663,40 @@ class MERRA2DataProcessor:
             newvar.attrs.update( varray.attrs )
         return newvar.where( newvar != newvar.attrs['fmissing_value'], np.nan )
 
-    def subsample(self, variable: xa.DataArray, global_attrs: Dict, qtype: QType, isconst: bool) -> xa.DataArray:
+    def clean(self, varray: xa.DataArray ) -> Tuple[xa.DataArray,QCReport]:
+        missing_values: List[float] = list( { varray.attrs.pop(missing) for missing in [ 'fmissing_value', 'missing_value', 'fill_value' ] if missing in varray.attrs } )
+        data: np.ndarray = varray.values.astype( np.float64 )
+        mask: np.ndarray = np.isnan( data )
+        nnan: int = int( np.count_nonzero( mask ) )
+        nmissing: int = 0
+        if len( missing_values ) > 0:
+            missing: np.ndarray = np.isin( data, np.asarray( missing_values, dtype=varray.dtype ).astype( np.float64 ) )
+            nmissing = int( np.count_nonzero( missing ) )
+            mask |= missing
+        filled, nremaining = self.gap_filler.fill_masked( data, mask, varray.dims, str(varray.name), nmask=nnan+nmissing, inplace=True )
+        cleaned: xa.DataArray = varray.copy( data=filled )
+        moments: Optional[Moments] = Moments.from_array( cleaned, StatsAccumulator.moment_dims( varray.dims ), nan_free=True ) if (nremaining == 0) else None
+        report = QCReport( str(varray.name), data.size, nnan, nmissing, nnan + nmissing - nremaining, nremaining, moments )
+        return cleaned.astype( np.result_type( varray.dtype, np.float32 ), copy=False ), report
+
+    def subsample(self, variable: xa.DataArray, global_attrs: Dict, qtype: QType, isconst: bool) -> Tuple[xa.DataArray,QCReport]:
         cmap: Dict[str, str] = {cn0: cn1 for (cn0, cn1) in self.dmap.items() if cn0 in list(variable.coords.keys())}
         varray: xa.DataArray = variable.rename(**cmap)
         if isconst and ("time" in varray.dims):
             varray = varray.isel( time=0, drop=True )
         scoords: Dict[str, np.ndarray] = self.subsample_coords(varray)
         print(f" **** subsample {variable.name}, dims={varray.dims}, shape={varray.shape}, new sizes: { {cn:cv.size for cn,cv in scoords.items()} }")
-        varray = varray.interp( x=scoords['x'], y=scoords['y'], assume_sorted=True)
+        varray = self.horizontal_window( varray, scoords )
+        if self.sample_instantaneous and ('time' in varray.dims) and global_attrs.get('collection','').startswith("inst"):
+            varray = self.sample_times( varray )
         if 'z' in scoords:
-            varray = varray.interp( z=scoords['z'], assume_sorted=False )
+            varray = LevelInterpolator.get( varray.coords['z'].values, scoords['z'] )( varray )
+        varray = self.regrid( varray, scoords )
         if 'time' in varray.dims:
             resampled: DataArrayResample = varray.resample(time=self.tstep)
             varray: xa.DataArray = resampled.mean() if qtype == QType.Intensive else resampled.sum()
         varray.attrs.update(global_attrs)
         varray.attrs.update(varray.attrs)
-        for missing in [ 'fmissing_value', 'missing_value', 'fill_value' ]:
-            if missing in varray.attrs:
-                missing_value = varray.attrs.pop('fmissing_value')
-                varray = varray.where( varray != missing_value, np.nan )
-        return replace_nans(varray).transpose(*self.corder, missing_dims="ignore" )
+        varray, report = self.clean( varray )
+        return varray.transpose(*self.corder, missing_dims="ignore" ), report
 
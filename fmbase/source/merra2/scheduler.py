@@ -0,0 +1,185 @@
+import os, traceback
+import numpy as np
+from typing import List, Union, Tuple, Optional, Dict, Type, Any, Set
+from datetime import date
+from multiprocessing import Pool, cpu_count
+from fmbase.util.config import cfg
+from fmbase.util.dates import drepr, year_range
+from fmbase.source.merra2.preprocess import MERRA2DataProcessor, StatsAccumulator
+from fmbase.source.merra2.model import cache_stats_filepath, manifest_filepath, cache_const_filepath, cache_const_stats_filepath, cache_year_stats_filepath
+
+def process_day_task( d: date ) -> Tuple[date,Optional[str]]:
+    try:
+        reader = MERRA2DataProcessor()
+        if not reader.process_day( d, reprocess=True ):
+            return d, f"No source data found for date {d}"
+        reader.stats.dump( cache_stats_filepath( cfg().preprocess.version, d ) )
+        return d, None
+    except Exception:
+        return d, traceback.format_exc()
+
+def process_month_task( task: Tuple[int,int,List[date]] ) -> List[Tuple[date,Optional[str]]]:
+    year, month, days = task
+    results: List[Tuple[date,Optional[str]]] = []
+    error: Optional[str] = None
+    try:
+        reader = MERRA2DataProcessor()
+        for d in reader.process_month( year, month, days, reprocess=True ):
+            carried: StatsAccumulator = reader.stats.carry()
+            reader.stats.dump( cache_stats_filepath( cfg().preprocess.version, d ) )
+            reader.stats = carried
+            results.append( (d, None) )
+    except Exception:
+        error = traceback.format_exc()
+    completed: Set[date] = { d for d, _ in results }
+    results.extend( [ (d, error or f"No source data found for date {d}") for d in days if d not in completed ] )
+    return results
+
+def reduce_stats_task( filepaths: List[str] ) -> StatsAccumulator:
+    return StatsAccumulator.load_reduced( filepaths, MERRA2DataProcessor().load_step )
+
+class PreprocessScheduler:
+    """  Resumable preprocessing: completed days are recorded in a persistent manifest together with their partial statistics,
+         so a restarted run only processes the missing days and the final stats are reduced from the persisted partials.
+         Partials of complete years are further reduced into per-year sufficient stats, so stats over a grown year range
+         only need the new years to be processed and reduced.  """
+
+    def __init__(self, **kwargs ):
+        self.version: str = cfg().preprocess.version
+        self.nproc: int = kwargs.get( 'nproc', cpu_count()-2 )
+        self.manifest: str = manifest_filepath( self.version )
+        self.storage: str = cfg().preprocess.get( 'storage', 'netcdf' )
+        self.granularity: str = kwargs.get( 'granularity', cfg().preprocess.get( 'task_granularity', 'day' ) )
+        if kwargs.get( 'reprocess', False ): self.clear_manifest()
+
+    def clear_manifest(self):
+        if os.path.exists(self.manifest): os.remove( self.manifest )
+
+    def completed(self) -> Set[str]:
+        if not os.path.exists(self.manifest): return set()
+        with open( self.manifest ) as f:
+            drs: Set[str] = { line.strip() for line in f if line.strip() }
+        return { dr for dr in drs if os.path.exists( self.stats_filepath(dr) ) }
+
+    def stats_filepath(self, dr: str ) -> str:
+        return cache_stats_filepath( self.version, date( *[int(dp) for dp in dr.split("-")] ) )
+
+    def mark_complete(self, d: date ):
+        os.makedirs(os.path.dirname(self.manifest), mode=0o777, exist_ok=True)
+        year_stats_file: str = cache_year_stats_filepath( self.version, d.year )
+        if os.path.exists( year_stats_file ): os.remove( year_stats_file )
+        with open( self.manifest, "a" ) as f:
+            f.write( f"{drepr(d)}\n" )
+            f.flush()
+            os.fsync( f.fileno() )
+
+    def forget(self, dates: List[date] ):
+        drs: Set[str] = { drepr(d) for d in dates }
+        if os.path.exists(self.manifest):
+            with open( self.manifest ) as f:
+                retained: List[str] = [ line for line in f if line.strip() and (line.strip() not in drs) ]
+            tmp_path = f"{self.manifest}.{os.getpid()}.tmp"
+            with open( tmp_path, "w" ) as f:
+                f.writelines( retained )
+            os.replace( tmp_path, self.manifest )
+        for d in dates:
+            stats_file: str = self.stats_filepath( drepr(d) )
+            if os.path.exists( stats_file ): os.remove( stats_file )
+        for year in { d.year for d in dates }:
+            year_stats_file: str = cache_year_stats_filepath( self.version, year )
+            if os.path.exists( year_stats_file ): os.remove( year_stats_file )
+
+    def pending(self, dates: List[date] ) -> List[date]:
+        completed: Set[str] = self.completed()
+        return [ d for d in dates if drepr(d) not in completed ]
+
+    @classmethod
+    def month_tasks(cls, dates: List[date] ) -> List[Tuple[int,int,List[date]]]:
+        months: Dict[Tuple[int,int],List[date]] = {}
+        for d in dates:
+            months.setdefault( (d.year, d.month), [] ).append( d )
+        return [ (year, month, days) for (year, month), days in months.items() ]
+
+    def build_constants(self, d: date ):
+        if os.path.exists( cache_const_filepath( self.version ) ): return
+        processor = MERRA2DataProcessor()
+        processor.build_constants( d )
+        if len( processor.stats.entries ) > 0:
+            processor.stats.dump( cache_const_stats_filepath( self.version ) )
+
+    def run(self, dates: List[date] ) -> List[date]:
+        pending: List[date] = self.pending( dates )
+        if len(dates) > 0: self.build_constants( dates[0] )
+        failed: List[date] = []
+        ndone: int = 0
+        print( f"Multiprocessing {len(pending)} of {len(dates)} days with {self.nproc} procs, granularity={self.granularity}")
+        if (self.storage == "zarr") and (len(pending) > 0) and not MERRA2DataProcessor().zarr_store.initialized:
+            d, error = process_day_task( pending.pop(0) )
+            if error is not None: raise Exception( f"Zarr store initialization failed for date {d}:\n{error}" )
+            self.mark_complete( d )
+        with Pool(processes=self.nproc) as pool:
+            if self.granularity == "month":
+                results = ( r for mresults in pool.imap_unordered( process_month_task, self.month_tasks(pending) ) for r in mresults )
+            else:
+                results = pool.imap_unordered( process_day_task, pending )
+            for (d, error) in results:
+                if error is None:
+                    self.mark_complete( d )
+                else:
+                    failed.append( d )
+                    print( f" ** Processing failed for date {d}:\n{error}")
+                ndone += 1
+                if ndone % 100 == 0: print( f" ** Completed {ndone}/{len(pending)} days, {len(failed)} failures")
+        if len(failed) > 0: print( f" ** {len(failed)} days failed and will be retried on restart: {[drepr(d) for d in failed]}")
+        return failed
+
+    def reduce_partials(self, filepaths: List[str] ) -> StatsAccumulator:
+        nchunks: int = max( min( self.nproc, len(filepaths) // 2 ), 1 )
+        if nchunks == 1: return reduce_stats_task( filepaths )
+        bounds: np.ndarray = np.linspace( 0, len(filepaths), nchunks+1 ).astype(int)
+        chunks: List[List[str]] = [ filepaths[bounds[ic]:bounds[ic+1]] for ic in range(nchunks) ]
+        with Pool(processes=nchunks) as pool:
+            partials: List[StatsAccumulator] = pool.map( reduce_stats_task, chunks )
+        return StatsAccumulator.reduce( partials, MERRA2DataProcessor().load_step )
+
+    def reduce_year(self, year: int ) -> bool:
+        year_stats_file: str = cache_year_stats_filepath( self.version, year )
+        if os.path.exists( year_stats_file ): return True
+        dates: List[date] = year_range( year, year+1 )
+        if len( self.pending(dates) ) > 0: return False
+        self.reduce_partials( [ self.stats_filepath( drepr(d) ) for d in dates ] ).dump( year_stats_file )
+        print( f" >> Reduced {len(dates)} daily partial stats into '{year_stats_file}'")
+        return True
+
+    def stats_files(self, dates: List[date] ) -> List[str]:
+        filepaths: List[Tuple[date,str]] = []
+        drs: Set[str] = { drepr(d) for d in dates }
+        for year in sorted( { d.year for d in dates } ):
+            year_drs: Set[str] = { drepr(d) for d in year_range( year, year+1 ) }
+            year_stats_file: str = cache_year_stats_filepath( self.version, year )
+            if year_drs.issubset( drs ) and os.path.exists( year_stats_file ):
+                filepaths.append( ( date(year,1,1), year_stats_file ) )
+                drs -= year_drs
+        completed: Set[str] = self.completed()
+        filepaths.extend( [ ( date( *[int(dp) for dp in dr.split("-")] ), self.stats_filepath(dr) ) for dr in drs & completed ] )
+        const_stats_file: str = cache_const_stats_filepath( self.version )
+        stats_files: List[str] = [ filepath for _, filepath in sorted( filepaths ) ]
+        if os.path.exists( const_stats_file ): stats_files.insert( 0, const_stats_file )
+        return stats_files
+
+    def load_stats(self, dates: List[date] ) -> StatsAccumulator:
+        return self.reduce_partials( self.stats_files( dates ) )
+
+    def save_stats(self, dates: List[date] ):
+        processor = MERRA2DataProcessor()
+        processor.stats = self.load_stats( dates )
+        processor.save_stats()
+
+    def update_stats(self, years: List[int], replace: List[int] = None ) -> List[date]:
+        for year in ( [] if replace is None else replace ):
+            self.forget( year_range( year, year+1 ) )
+        missing: List[int] = [ year for year in years if not os.path.exists( cache_year_stats_filepath( self.version, year ) ) ]
+        failed: List[date] = self.run( sum( [ year_range( year, year+1 ) for year in missing ], [] ) )
+        for year in missing: self.reduce_year( year )
+        if len(failed) == 0: self.save_stats( sum( [ year_range( year, year+1 ) for year in years ], [] ) )
+        return failed
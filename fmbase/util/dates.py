@@ -47,3 +47,10 @@ def year_range( y0: int, y1: int, **kwargs )-> List[date]:
 	rlist = date_range( date(y0,1,1), date(y1,1,1) )
 	if randomize: random.shuffle(rlist)
 	return rlist
+
+def strided_dates( start: date, num_dates: int, stride: int = 1 )-> List[date]:
+	return [ start + timedelta(days=idate*stride) for idate in range(num_dates) ]
+
+def random_dates( start: date, end: date, num_dates: int, seed: int = None )-> List[date]:
+	rng = random.Random( seed )
+	return [ start + timedelta(days=iday) for iday in rng.sample( range( (end-start).days ), num_dates ) ]
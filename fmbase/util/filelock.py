@@ -0,0 +1,20 @@
+import os, fcntl
+from typing import Any, Dict, List, Tuple, Type, Optional, Union
+
+class FileLock:
+	"""  Exclusive inter-process lock on a lock file (fcntl.flock), used as a context manager; blocks until the lock is acquired.  """
+
+	def __init__(self, path: str ):
+		self.path: str = path
+		self._fd: Optional[int] = None
+
+	def __enter__(self) -> "FileLock":
+		os.makedirs( os.path.dirname(self.path), mode=0o777, exist_ok=True )
+		self._fd = os.open( self.path, os.O_CREAT | os.O_RDWR, 0o666 )
+		fcntl.flock( self._fd, fcntl.LOCK_EX )
+		return self
+
+	def __exit__(self, *args ):
+		fcntl.flock( self._fd, fcntl.LOCK_UN )
+		os.close( self._fd )
+		self._fd = None
@@ -1,4 +1,4 @@
-import os, glob, numpy as np
+import os, glob, hashlib, numpy as np
 from .parse import parse
 from omegaconf import DictConfig, OmegaConf
 from typing import Any, Dict, List, Tuple, Type, Optional, Union
@@ -124,13 +124,75 @@ def increasing( data: np.ndarray ) -> bool:
 	xl = data.tolist()
 	return xl[-1] > xl[0]
 
-def replace_nans(level_array: xa.DataArray) -> xa.DataArray:
-	if nnan(level_array) > 0:
-		level_array = level_array.interpolate_na(dim='x', method="linear", fill_value="extrapolate")
-		if nnan(level_array) > 0:
-			level_array = level_array.interpolate_na(dim='y', method="linear", fill_value="extrapolate")
-		assert nnan(level_array) == 0, "NaNs remaining after replace_nans()"
-	return level_array
+def line_fill_map( valid: np.ndarray, flat_index: np.ndarray ) -> Tuple[np.ndarray,np.ndarray,np.ndarray,np.ndarray,np.ndarray]:
+	"""  Linear interpolation/extrapolation map along the last axis for every invalid point on lines with at least two valid points.
+	     Returns (target, left, right, weight) flat indices/weights plus the mask of points that could not be filled.  """
+	lshape, n = valid.shape, valid.shape[-1]
+	valid, flat_index = valid.reshape(-1,n), flat_index.reshape(-1,n)
+	pos: np.ndarray = np.broadcast_to( np.arange(n), valid.shape )
+	prev: np.ndarray = np.maximum.accumulate( np.where( valid, pos, -1 ), axis=-1 )
+	nxt: np.ndarray = np.flip( np.minimum.accumulate( np.flip( np.where( valid, pos, n ), axis=-1 ), axis=-1 ), axis=-1 )
+	nvalid: np.ndarray = np.count_nonzero( valid, axis=-1 )[..., np.newaxis]
+	first: np.ndarray = nxt[..., :1]
+	second: np.ndarray = np.take_along_axis( nxt, np.minimum( first+1, n-1 ), axis=-1 )
+	last: np.ndarray = prev[..., -1:]
+	penult: np.ndarray = np.take_along_axis( prev, np.maximum( last-1, 0 ), axis=-1 )
+	left: np.ndarray = np.where( prev < 0, first, np.where( nxt >= n, penult, prev ) )
+	right: np.ndarray = np.where( prev < 0, second, np.where( nxt >= n, last, nxt ) )
+	fillable: np.ndarray = (~valid) & (nvalid >= 2)
+	ilines, ipos = np.nonzero( fillable )
+	il, ir = left[ilines, ipos], right[ilines, ipos]
+	weight: np.ndarray = (ipos - il) / (ir - il)
+	return flat_index[ilines, ipos], flat_index[ilines, il], flat_index[ilines, ir], weight, ((~valid) & ~fillable).reshape(lshape)
+
+class GapFiller:
+	"""  Single-scan NaN gap filling: linear interpolation (with extrapolation) along x, falling back to y for rows without enough valid
+	     points. The fill index map is cached by NaN mask, so static masks (e.g. below-ground pressure levels) are mapped only once.  """
+	max_cached = 64
+
+	def __init__(self):
+		self._maps: Dict[Tuple,List[Tuple[np.ndarray,np.ndarray,np.ndarray,np.ndarray]]] = {}
+		self.fill_counts: Dict[str,int] = {}
+
+	def fill_map( self, mask: np.ndarray, dims: Tuple[str,...] ) -> List[Tuple[np.ndarray,np.ndarray,np.ndarray,np.ndarray]]:
+		key = ( mask.shape, dims, hashlib.sha1( np.packbits(mask).tobytes() ).hexdigest() )
+		fmap = self._maps.get( key )
+		if fmap is None:
+			fmap, valid = [], ~mask
+			flat_index: np.ndarray = np.arange( mask.size ).reshape( mask.shape )
+			for dim in ['x','y']:
+				if (dim not in dims) or valid.all(): continue
+				axis: int = dims.index(dim)
+				target, left, right, weight, unfilled = line_fill_map( np.moveaxis( valid, axis, -1 ), np.moveaxis( flat_index, axis, -1 ) )
+				fmap.append( (target, left, right, weight) )
+				valid = ~np.moveaxis( unfilled, -1, axis )
+			if len(self._maps) >= self.max_cached: self._maps.pop( next(iter(self._maps)) )
+			self._maps[key] = fmap
+		return fmap
+
+	def fill_masked( self, data: np.ndarray, mask: np.ndarray, dims: Tuple[str,...], name: str, nmask: int = None, inplace: bool = False ) -> Tuple[np.ndarray,int]:
+		"""  Fill the points flagged in mask (which need not be NaN in data), returning the filled array and the number of points left unfilled.
+		     Pass nmask if the caller has already counted the mask, and inplace to fill a float buffer owned by the caller without copying it.  """
+		nmask: int = int( np.count_nonzero( mask ) ) if (nmask is None) else nmask
+		if nmask == 0:
+			self.fill_counts[name] = 0
+			return data, 0
+		filled: np.ndarray = data.astype( np.result_type( data.dtype, np.float32 ), copy=not inplace ).reshape(-1)
+		filled[ mask.reshape(-1) ] = np.nan
+		nfilled: int = 0
+		for (target, left, right, weight) in self.fill_map( mask, dims ):
+			dl, dr = filled[left], filled[right]
+			filled[target] = dl + weight.astype(filled.dtype)*(dr-dl)
+			nfilled += target.size
+		self.fill_counts[name] = nfilled
+		return filled.reshape( data.shape ), nmask - nfilled
+
+	def fill( self, varray: xa.DataArray ) -> xa.DataArray:
+		data: np.ndarray = varray.values
+		filled, nremaining = self.fill_masked( data, np.isnan( data ), varray.dims, str(varray.name) )
+		assert nremaining == 0, "NaNs remaining after GapFiller.fill()"
+		return varray if (filled is data) else varray.copy( data=filled )
+
 def format_timedelta( td: np.timedelta64, form: str, strf: bool = True ) -> Union[str, float,int]:
 	s = td.astype('timedelta64[s]').astype(np.int32)
 	hours, remainder = divmod(s, 3600)
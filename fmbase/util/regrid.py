@@ -0,0 +1,116 @@
+import os, hashlib, numpy as np
+import xarray as xa
+from typing import Any, Dict, List, Tuple, Type, Optional, Union
+
+def linear_weights( src: np.ndarray, dst: np.ndarray ) -> Tuple[np.ndarray,np.ndarray,np.ndarray]:
+	"""  Bracketing source indices (i0,i1) and weight w such that dst = (1-w)*src[i0] + w*src[i1];  w is NaN outside the source range.  """
+	src, dst = np.asarray(src,dtype=np.float64), np.asarray(dst,dtype=np.float64)
+	order: np.ndarray = np.argsort( src, kind="stable" )
+	ssrc: np.ndarray = src[order]
+	i1: np.ndarray = np.clip( np.searchsorted( ssrc, dst, side='right' ), 1, ssrc.size-1 )
+	i0: np.ndarray = i1 - 1
+	w: np.ndarray = (dst - ssrc[i0]) / (ssrc[i1] - ssrc[i0])
+	w[ (dst < ssrc[0]) | (dst > ssrc[-1]) ] = np.nan
+	return order[i0], order[i1], w
+
+class Regridder:
+	"""  Separable linear regridding between two fixed rectilinear (x,y) grids, with weights computed once per grid pair and cached in memory and on disk.  """
+	_instances: Dict[str,"Regridder"] = {}
+
+	def __init__(self, weights: Dict[str,Tuple[np.ndarray,np.ndarray,np.ndarray]], dst: Dict[str,np.ndarray] ):
+		self.weights: Dict[str,Tuple[np.ndarray,np.ndarray,np.ndarray]] = weights
+		self.dst: Dict[str,np.ndarray] = dst
+
+	@classmethod
+	def grid_key(cls, src: Dict[str,np.ndarray], dst: Dict[str,np.ndarray] ) -> str:
+		h = hashlib.sha1()
+		for cname in sorted(dst.keys()):
+			for grid in [ src[cname], dst[cname] ]:
+				h.update( cname.encode() )
+				h.update( np.ascontiguousarray( grid, dtype=np.float64 ).tobytes() )
+		return h.hexdigest()
+
+	@classmethod
+	def get(cls, src: Dict[str,np.ndarray], dst: Dict[str,np.ndarray], cache_dir: str = None ) -> "Regridder":
+		key: str = cls.grid_key( src, dst )
+		regridder: Optional[Regridder] = cls._instances.get(key)
+		if regridder is None:
+			cache_file: Optional[str] = None if (cache_dir is None) else f"{cache_dir}/{key}.npz"
+			if (cache_file is not None) and os.path.exists(cache_file):
+				regridder = cls.load( cache_file, dst )
+			else:
+				regridder = Regridder( { cname: linear_weights( src[cname], dst[cname] ) for cname in dst.keys() }, dst )
+				if cache_file is not None: regridder.save( cache_file )
+			cls._instances[key] = regridder
+		return regridder
+
+	@classmethod
+	def load(cls, filepath: str, dst: Dict[str,np.ndarray] ) -> "Regridder":
+		with np.load( filepath ) as wdata:
+			weights = { cname: ( wdata[f"{cname}_i0"], wdata[f"{cname}_i1"], wdata[f"{cname}_w"] ) for cname in dst.keys() }
+		return Regridder( weights, dst )
+
+	def save(self, filepath: str ):
+		os.makedirs( os.path.dirname(filepath), mode=0o777, exist_ok=True )
+		wdata: Dict[str,np.ndarray] = {}
+		for cname, (i0, i1, w) in self.weights.items():
+			wdata.update( { f"{cname}_i0": i0, f"{cname}_i1": i1, f"{cname}_w": w } )
+		tmp_path = f"{filepath}.{os.getpid()}.tmp.npz"
+		np.savez( tmp_path, **wdata )
+		os.replace( tmp_path, filepath )
+
+	@classmethod
+	def apply_weights(cls, data: np.ndarray, axis: int, weights: Tuple[np.ndarray,np.ndarray,np.ndarray] ) -> np.ndarray:
+		i0, i1, w = weights
+		wshape = [1]*data.ndim
+		wshape[axis] = w.size
+		dtype = data.dtype if np.issubdtype( data.dtype, np.floating ) else np.float64
+		w = w.astype(dtype).reshape(wshape)
+		d0: np.ndarray = np.take( data, i0, axis=axis )
+		d1: np.ndarray = np.take( data, i1, axis=axis )
+		return d0 + w*(d1-d0)
+
+	def __call__(self, varray: xa.DataArray ) -> xa.DataArray:
+		data: np.ndarray = varray.values
+		for cname, weights in self.weights.items():
+			data = self.apply_weights( data, varray.get_axis_num(cname), weights )
+		coords = { cn: cv for cn, cv in varray.coords.items() if not (set(cv.dims) & set(self.weights.keys())) }
+		coords.update( { cname: self.dst[cname] for cname in self.weights.keys() } )
+		return xa.DataArray( data, dims=varray.dims, coords=coords, attrs=varray.attrs, name=varray.name )
+
+class LevelInterpolator:
+	"""  Vertical interpolation onto a fixed set of target levels, with weights computed once per source level set.  When every target level
+	     is present in the source levels, the interpolation reduces to an index selection, so only the required level slices are read.  """
+	_instances: Dict[bytes,"LevelInterpolator"] = {}
+
+	def __init__(self, src: np.ndarray, dst: np.ndarray, cname: str = 'z' ):
+		self.cname: str = cname
+		self.dst: np.ndarray = np.asarray(dst)
+		src: np.ndarray = np.asarray(src,dtype=np.float64)
+		matches: np.ndarray = np.isclose( src[np.newaxis,:], self.dst.astype(np.float64)[:,np.newaxis] )
+		self.indices: Optional[np.ndarray] = np.argmax( matches, axis=1 ) if matches.any(axis=1).all() else None
+		self.weights: Optional[Tuple[np.ndarray,np.ndarray,np.ndarray]] = linear_weights( src, self.dst ) if (self.indices is None) else None
+
+	@property
+	def is_subset(self) -> bool:
+		return self.indices is not None
+
+	@classmethod
+	def get(cls, src: np.ndarray, dst: np.ndarray, cname: str = 'z' ) -> "LevelInterpolator":
+		key: bytes = cname.encode() + np.ascontiguousarray( src, dtype=np.float64 ).tobytes() + b'|' + np.ascontiguousarray( dst, dtype=np.float64 ).tobytes()
+		interpolator: Optional[LevelInterpolator] = cls._instances.get(key)
+		if interpolator is None:
+			interpolator = LevelInterpolator( src, dst, cname )
+			cls._instances[key] = interpolator
+		return interpolator
+
+	def __call__(self, varray: xa.DataArray ) -> xa.DataArray:
+		if self.is_subset:
+			return varray.isel( **{self.cname: self.indices} ).assign_coords( **{self.cname: self.dst} )
+		i0, i1, w = self.weights
+		required: np.ndarray = np.union1d( i0, i1 )
+		weights = ( np.searchsorted( required, i0 ), np.searchsorted( required, i1 ), w )
+		data: np.ndarray = Regridder.apply_weights( varray.isel( **{self.cname: required} ).values, varray.get_axis_num(self.cname), weights )
+		coords = { cn: cv for cn, cv in varray.coords.items() if self.cname not in cv.dims }
+		coords[self.cname] = self.dst
+		return xa.DataArray( data, dims=varray.dims, coords=coords, attrs=varray.attrs, name=varray.name )
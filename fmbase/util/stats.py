@@ -0,0 +1,167 @@
+import numpy as np
+import xarray as xa
+from typing import Any, Dict, List, Tuple, Type, Optional, Union, Sequence
+
+class Moments:
+	"""  Fixed-size sufficient statistics (count, mean, M2) over a set of reduced dims, mergeable with Chan's parallel update.
+	     With weights (e.g. cos(latitude) area weights) count holds the sum of weights.  """
+
+	def __init__(self, dims: Sequence[str], coords: Dict[str,np.ndarray], attrs: Dict, count: np.ndarray, mean: np.ndarray, m2: np.ndarray ):
+		self.dims: Tuple[str,...] = tuple(dims)
+		self.coords: Dict[str,np.ndarray] = coords
+		self.attrs: Dict = attrs
+		self.count: np.ndarray = count
+		self.mean: np.ndarray = mean
+		self.m2: np.ndarray = m2
+
+	@classmethod
+	def weight_array(cls, data: xa.DataArray, weights: xa.DataArray ) -> np.ndarray:
+		wdims: List[str] = [ d for d in data.dims if d in weights.dims ]
+		shape: List[int] = [ data.sizes[d] if d in weights.dims else 1 for d in data.dims ]
+		return weights.transpose( *wdims ).values.astype(np.float64).reshape( shape )
+
+	@classmethod
+	def from_array(cls, data: xa.DataArray, dims: Sequence[str], nan_free: bool = False, weights: xa.DataArray = None ) -> "Moments":
+		axes: Tuple[int,...] = tuple( data.get_axis_num(d) for d in dims if d in data.dims )
+		values: np.ndarray = np.asarray( data.values, dtype=np.float64 )
+		if weights is not None:
+			w: np.ndarray = np.broadcast_to( cls.weight_array( data, weights ), values.shape )
+			if not nan_free:
+				valid: np.ndarray = ~np.isnan(values)
+				w, values = np.where( valid, w, 0.0 ), np.where( valid, values, 0.0 )
+			count: np.ndarray = np.asarray( np.sum( w, axis=axes ) )
+			total: np.ndarray = np.asarray( np.sum( w*values, axis=axes ) )
+		elif nan_free:
+			rshape = [ size for iax, size in enumerate(values.shape) if iax not in axes ]
+			count: np.ndarray = np.full( rshape, values.size / max(np.prod(rshape),1), dtype=np.float64 )
+			total: np.ndarray = np.asarray( np.sum( values, axis=axes ) )
+		else:
+			count: np.ndarray = np.asarray( np.count_nonzero( ~np.isnan(values), axis=axes ), dtype=np.float64 )
+			total: np.ndarray = np.asarray( np.nansum( values, axis=axes ) )
+		mean: np.ndarray = np.divide( total, count, out=np.zeros_like(total), where=(count > 0) )
+		dev: np.ndarray = values - np.expand_dims( mean, axes )
+		if weights is not None: m2: np.ndarray = np.asarray( np.sum( w*dev*dev, axis=axes ) )
+		else:                   m2: np.ndarray = np.asarray( (np.sum if nan_free else np.nansum)( dev*dev, axis=axes ) )
+		kdims: List[str] = [ d for d in data.dims if d not in dims ]
+		coords: Dict[str,np.ndarray] = { d: data.coords[d].values for d in kdims if d in data.coords }
+		return Moments( kdims, coords, dict(data.attrs), count, mean, m2 )
+
+	def group(self, dim: str, labels: np.ndarray, newdim: str, newcoords: Dict = None ) -> "Moments":
+		"""  Combine the moments along dim into one set per distinct label (e.g. latitude rows into latitude bands).  """
+		axis: int = self.dims.index( dim )
+		counts, means, m2s = [], [], []
+		for label in np.unique( labels ):
+			isel: np.ndarray = np.nonzero( labels == label )[0]
+			count, mean = np.take( self.count, isel, axis ), np.take( self.mean, isel, axis )
+			gcount: np.ndarray = count.sum( axis )
+			gmean: np.ndarray = np.divide( (count*mean).sum(axis), gcount, out=np.zeros_like(gcount), where=(gcount > 0) )
+			dev: np.ndarray = mean - np.expand_dims( gmean, axis )
+			counts.append( gcount )
+			means.append( gmean )
+			m2s.append( ( np.take( self.m2, isel, axis ) + count*dev*dev ).sum( axis ) )
+		dims: List[str] = [ newdim if d == dim else d for d in self.dims ]
+		coords: Dict[str,np.ndarray] = { cn: cv for cn, cv in self.coords.items() if cn != dim }
+		if newcoords is not None: coords.update( newcoords )
+		return Moments( dims, coords, self.attrs, np.stack(counts,axis), np.stack(means,axis), np.stack(m2s,axis) )
+
+	def merge(self, other: "Moments") -> "Moments":
+		count: np.ndarray = self.count + other.count
+		delta: np.ndarray = other.mean - self.mean
+		frac: np.ndarray = np.divide( other.count, count, out=np.zeros_like(count), where=(count > 0) )
+		self.mean = self.mean + delta*frac
+		self.m2 = self.m2 + other.m2 + delta*delta*self.count*frac
+		self.count = count
+		return self
+
+	@property
+	def variance(self) -> np.ndarray:
+		return np.divide( self.m2, self.count, out=np.full_like(self.m2,np.nan), where=(self.count > 0) )
+
+	def stat(self, statname: str ) -> xa.DataArray:
+		if   statname == "mean":  values = self.mean
+		elif statname == "var":   values = self.variance
+		elif statname == "std":   values = np.sqrt( self.variance )
+		elif statname == "count": values = self.count
+		else: raise Exception( f"Moments: unknown stat: {statname}" )
+		return xa.DataArray( values, dims=self.dims, coords=self.coords, attrs=self.attrs )
+
+class LogHistogram:
+	"""  Mergeable quantile sketch: counts over fixed, data-independent, signed log-spaced bins (plus a bin around zero) per element of
+	     the kept dims, with running min/max.  Quantiles are interpolated within bins, with relative error below 10**(1/bins_per_decade)-1.  """
+
+	def __init__(self, dims: Sequence[str], coords: Dict[str,np.ndarray], attrs: Dict, counts: np.ndarray, vmin: np.ndarray, vmax: np.ndarray,
+	             min_exp: int = -12, max_exp: int = 12, bins_per_decade: int = 32 ):
+		self.dims: Tuple[str,...] = tuple(dims)
+		self.coords: Dict[str,np.ndarray] = coords
+		self.attrs: Dict = attrs
+		self.counts: np.ndarray = counts
+		self.vmin: np.ndarray = vmin
+		self.vmax: np.ndarray = vmax
+		self.min_exp: int = min_exp
+		self.max_exp: int = max_exp
+		self.bins_per_decade: int = bins_per_decade
+
+	@classmethod
+	def half_bins(cls, min_exp: int, max_exp: int, bins_per_decade: int ) -> int:
+		return (max_exp - min_exp) * bins_per_decade
+
+	@property
+	def edges(self) -> np.ndarray:
+		nh: int = self.half_bins( self.min_exp, self.max_exp, self.bins_per_decade )
+		exps: np.ndarray = self.min_exp + np.arange( nh+1 ) / self.bins_per_decade
+		return np.concatenate( [ -np.power( 10.0, exps[:0:-1] ), [ -np.power( 10.0, exps[0] ) ], np.power( 10.0, exps ) ] )
+
+	@classmethod
+	def from_array(cls, data: xa.DataArray, dims: Sequence[str], min_exp: int = -12, max_exp: int = 12, bins_per_decade: int = 32 ) -> "LogHistogram":
+		kdims: List[str] = [ d for d in data.dims if d not in dims ]
+		values: np.ndarray = data.transpose( *kdims, *[ d for d in data.dims if d in dims ] ).values
+		values = values.astype( np.result_type( values.dtype, np.float32 ), copy=False )
+		kshape: Tuple[int,...] = values.shape[:len(kdims)]
+		nrows: int = int( np.prod( kshape ) )
+		values = values.reshape( nrows, -1 )
+		nh: int = cls.half_bins( min_exp, max_exp, bins_per_decade )
+		nbins: int = 2*nh + 1
+		ilog: np.ndarray = np.abs( values )
+		with np.errstate( divide='ignore', invalid='ignore' ):
+			np.log10( ilog, out=ilog )
+		ilog -= min_exp
+		ilog *= bins_per_decade
+		np.floor( ilog, out=ilog )
+		np.nan_to_num( ilog, copy=False, nan=0.0, neginf=-1.0 )
+		np.clip( ilog, -1, nh-1, out=ilog )
+		ibin: np.ndarray = ilog.astype(np.int32)
+		del ilog
+		zero: np.ndarray = (ibin < 0)
+		ibin = np.where( values > 0, nh + 1 + ibin, nh - 1 - ibin ).astype( np.int32, copy=False )
+		ibin[zero] = nh
+		ibin += ( np.arange( nrows, dtype=np.int32 ) * nbins )[:,None]
+		ibin[ np.isnan(values) ] = nrows*nbins
+		counts: np.ndarray = np.bincount( ibin.reshape(-1), minlength=nrows*nbins+1 )[:-1].astype(np.int32).reshape( *kshape, nbins )
+		vmin: np.ndarray = np.fmin.reduce( values, axis=1 ).astype(np.float64).reshape( kshape )
+		vmax: np.ndarray = np.fmax.reduce( values, axis=1 ).astype(np.float64).reshape( kshape )
+		coords: Dict[str,np.ndarray] = { d: data.coords[d].values for d in kdims if d in data.coords }
+		return LogHistogram( kdims, coords, dict(data.attrs), counts, vmin, vmax, min_exp, max_exp, bins_per_decade )
+
+	def merge(self, other: "LogHistogram") -> "LogHistogram":
+		self.counts = self.counts.astype(np.int64) + other.counts
+		self.vmin = np.fmin( self.vmin, other.vmin )
+		self.vmax = np.fmax( self.vmax, other.vmax )
+		return self
+
+	def quantiles(self, qs: Sequence[float] ) -> xa.DataArray:
+		edges: np.ndarray = self.edges
+		nbins: int = edges.size - 1
+		counts: np.ndarray = self.counts.reshape( -1, nbins ).astype(np.float64)
+		cum: np.ndarray = np.cumsum( counts, axis=1 )
+		irows: np.ndarray = np.arange( counts.shape[0] )
+		result: List[np.ndarray] = []
+		for q in qs:
+			target: np.ndarray = q * cum[:,-1]
+			ibin: np.ndarray = np.minimum( np.sum( cum < target[:,None], axis=1 ), nbins-1 )
+			bcount: np.ndarray = counts[irows,ibin]
+			frac: np.ndarray = np.divide( target - (cum[irows,ibin] - bcount), bcount, out=np.zeros_like(bcount), where=(bcount > 0) )
+			qvalue: np.ndarray = edges[ibin] + frac * ( edges[ibin+1] - edges[ibin] )
+			qvalue = np.clip( qvalue, self.vmin.reshape(-1), self.vmax.reshape(-1) )
+			result.append( np.where( cum[:,-1] > 0, qvalue, np.nan ) )
+		values: np.ndarray = np.stack( result ).reshape( len(qs), *self.counts.shape[:-1] )
+		return xa.DataArray( values, dims=('quantile',)+self.dims, coords=dict( quantile=np.array(qs), **self.coords ), attrs=self.attrs )
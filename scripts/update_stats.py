@@ -0,0 +1,17 @@
+from fmbase.source.merra2.scheduler import PreprocessScheduler
+from fmbase.util.config import configure, cfg
+from typing import List, Tuple
+from datetime import date
+from multiprocessing import cpu_count
+import hydra, os
+
+hydra.initialize( version_base=None, config_path="../config" )
+configure( 'merra2-finetuning' )
+nproc = cpu_count()-2
+yrange: Tuple[int,int] = cfg().preprocess.year_range
+replace: List[int] = []
+
+if __name__ == '__main__':
+	scheduler = PreprocessScheduler( nproc=nproc )
+	failed: List[date] = scheduler.update_stats( list( range( *yrange ) ), replace )
+	if len(failed) > 0: print( f" ** Stats not updated: {len(failed)} days failed and will be retried on restart")
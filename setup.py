@@ -15,7 +15,7 @@ setup(
     keywords="Foundation Model Weather Climate",
     url="https://github.com/nasa-nccs-cds/FoundationModelBase.git",
     packages=find_packages(),
-    install_requires=[ "pydap", "numpy", "xarray", "dask", "matplotlib", "scipy", "netCDF4", "hydra-core"],
+    install_requires=[ "pydap", "numpy", "xarray", "dask", "matplotlib", "scipy", "netCDF4", "zarr", "hydra-core"],
     classifiers=[
         "Development Status :: 3 - Alpha",
         "Intended Audience :: Science/Research",